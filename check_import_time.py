@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the import time of video_tools and video_player.
+
+Importing them must not load GStreamer (gi) or matplotlib, which are loaded
+on first use, and must stay within a time budget on top of numpy, so that
+scripts that only parse timestamp logs or frame indices start fast.
+
+Usage:
+    python check_import_time.py [budget_ms]
+
+Exits with status 1 if a module is over budget or loads gi or matplotlib.
+"""
+import json
+import subprocess
+import sys
+
+# Import time budget, in ms, excluding numpy
+BUDGET_MS = 50.0
+
+_CHILD = '''
+import json, sys, time
+import numpy
+t0 = time.perf_counter()
+import %s
+dt = time.perf_counter() - t0
+print(json.dumps({'ms': 1e3 * dt,
+                  'gi': 'gi' in sys.modules,
+                  'matplotlib': 'matplotlib' in sys.modules}))
+'''
+
+
+def import_time(module, n=5):
+    """
+    Returns the import time, in ms and excluding numpy, of module, the best
+    of n fresh interpreters, and whether gi and matplotlib were loaded.
+    """
+    best = None
+    for i in range(n):
+        out = subprocess.check_output([sys.executable, '-c', _CHILD % module])
+        res = json.loads(out.decode().strip().splitlines()[-1])
+        if best is None or res['ms'] < best['ms']:
+            best = res
+    return best
+
+
+def main(budget_ms=BUDGET_MS):
+    ok = True
+    for module in ('video_tools', 'video_player'):
+        res = import_time(module)
+        over = res['ms'] > budget_ms
+        heavy = [m for m in ('gi', 'matplotlib') if res[m]]
+        print('%s: %0.1f ms (budget %0.1f ms)%s' %
+              (module, res['ms'], budget_ms,
+               ', loads %s' % ', '.join(heavy) if heavy else ''))
+        if over or heavy:
+            ok = False
+    return ok
+
+
+if __name__ == '__main__':
+    budget_ms = float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET_MS
+    sys.exit(0 if main(budget_ms) else 1)
@@ -0,0 +1,123 @@
+"""
+Round trips of the timestamp logs written by Webcam: text and binary
+logs, convert_timestamp_log and split_timestamp_log.
+"""
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import video_tools  # noqa: E402
+
+HEADER = ('video fname: session.mkv\nstart_time: 2026-01-01 00:00:00.000000\n'
+          'frame_number, offset_ts, cam_running_ts, python_ts\n')
+
+# frame_n, buf_ts, py_ts, n_missing, at 10 fps with gaps before frames 4
+# and 9
+RECORDS = [(1, 0.1, 100.1, 0),
+           (2, 0.2, 100.2, 0),
+           (4, 0.4, 100.4, 1),
+           (5, 0.5, 100.5, 0),
+           (6, 0.6, 100.6, 0),
+           (9, 0.9, 100.9, 2),
+           (10, 1.0, 101.0, 0)]
+
+
+def _write_text_log(fname, records=RECORDS):
+    log = video_tools.TextTimestampLog(fname, HEADER, flag_gaps=True)
+    for record in records:
+        log.write(*record)
+    log.close()
+
+
+def _write_binary_log(fname, records=RECORDS):
+    log = video_tools.BinaryTimestampLog(fname,
+                                         meta={'video fname': 'session.mkv'})
+    for record in records:
+        log.write(*record)
+    log.close()
+
+
+def _expected(records=RECORDS):
+    return np.array(records, dtype=video_tools._tslog_dtype)
+
+
+def _assert_records_equal(records, expected):
+    assert records.dtype == video_tools._tslog_dtype
+    np.testing.assert_array_equal(records['frame_n'], expected['frame_n'])
+    np.testing.assert_allclose(records['buf_ts'], expected['buf_ts'])
+    np.testing.assert_allclose(records['py_ts'], expected['py_ts'])
+    np.testing.assert_array_equal(records['n_missing'],
+                                  expected['n_missing'])
+
+
+def test_text_log_round_trip(tmp_path):
+    fname = str(tmp_path / 'tslog.txt')
+    _write_text_log(fname)
+    records, meta = video_tools.load_timestamp_log(fname)
+    _assert_records_equal(records, _expected())
+    assert meta['video fname'] == 'session.mkv'
+
+
+def test_text_log_header_only(tmp_path):
+    fname = str(tmp_path / 'tslog.txt')
+    _write_text_log(fname, [])
+    records, meta = video_tools.load_timestamp_log(fname)
+    assert len(records) == 0
+    assert records.dtype == video_tools._tslog_dtype
+
+
+def test_binary_log_round_trip(tmp_path):
+    fname = str(tmp_path / 'tslog.bin')
+    _write_binary_log(fname)
+    assert video_tools.is_binary_timestamp_log(fname)
+    records, meta = video_tools.load_timestamp_log(fname)
+    _assert_records_equal(records, _expected())
+    assert meta == {'video fname': 'session.mkv'}
+
+
+def test_convert_keeps_gaps(tmp_path):
+    fname = str(tmp_path / 'tslog.txt')
+    _write_text_log(fname)
+    bin_fname = video_tools.convert_timestamp_log(fname)
+    assert video_tools.is_binary_timestamp_log(bin_fname)
+    records, meta = video_tools.load_timestamp_log(bin_fname)
+    _assert_records_equal(records, _expected())
+    assert meta['video fname'] == 'session.mkv'
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_split_round_trip(tmp_path, binary):
+    fname = str(tmp_path / ('tslog.bin' if binary else 'tslog.txt'))
+    if binary:
+        _write_binary_log(fname)
+    else:
+        _write_text_log(fname)
+    manifest = {'segments': [
+        {'fname': str(tmp_path / 'session_00000.mkv'),
+         'start_ts': 0.15, 'end_ts': 0.5},
+        {'fname': str(tmp_path / 'session_00001.mkv'),
+         'start_ts': 0.5, 'end_ts': 0.9},
+        {'fname': str(tmp_path / 'session_00002.mkv'),
+         'start_ts': 0.9, 'end_ts': 1.0}]}
+    fnames = video_tools.split_timestamp_log(fname, manifest)
+    assert fnames == ['%slog' % seg['fname'][:-3]
+                      for seg in manifest['segments']]
+
+    expected = _expected()
+    # Records before the first segment go to it
+    bounds = [0, 3, 5, 7]
+    for i, seg_fname in enumerate(fnames):
+        records, meta = video_tools.load_timestamp_log(seg_fname)
+        _assert_records_equal(records, expected[bounds[i]:bounds[i + 1]])
+        assert meta['video fname'] == manifest['segments'][i]['fname']
+        assert float(meta['start_ts']) == \
+            manifest['segments'][i]['start_ts']
+
+    if not binary:
+        # The gap lines are copied along with their records
+        with open(fnames[2], 'r') as f:
+            assert '# 2 frames missing\n' in f.read()
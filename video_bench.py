@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of video_tools: VideoReader decoding and seeking, and Webcam
+capture pipelines, on synthetic test videos made locally with videotestsrc.
+
+Every measurement runs in a fresh process, so that the peak RSS reported is
+that of a single reader or capture pipeline.
+
+Usage:
+    python video_bench.py --out results.json
+    python video_bench.py --out new.json --compare results.json
+
+Results are written as JSON, with one record per benchmark and parameter
+set, and can be compared with an earlier run to find regressions.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+
+import video_tools
+from video_tools import VideoReader, Webcam
+
+# Encoder launch descriptions of the test videos
+ENCODERS = {'theora': 'theoraenc',
+            'vp8': 'vp8enc deadline=1',
+            'x264': 'x264enc'}
+
+SIZES = [(320, 240), (640, 480), (1280, 720)]
+
+
+def make_test_video(fname, encoder='theora', width=640, height=480,
+                    fps=30, duration=10.0):
+    """
+    Writes a synthetic test video, videotestsrc encoded into matroska.
+
+    Parameters
+    ----------
+    fname    -- output filename (str)
+    encoder  -- 'theora', 'vp8' or 'x264'
+    width    -- frame width (int)
+    height   -- frame height (int)
+    fps      -- frame rate (int)
+    duration -- duration in seconds (float)
+    """
+    video_tools._init_gst()
+    Gst = video_tools.Gst
+    s = ('videotestsrc num-buffers=%d pattern=ball '
+         '! video/x-raw, width=%d, height=%d, framerate=%d/1 '
+         '! videoconvert '
+         '! %s '
+         '! matroskamux '
+         '! filesink location="%s"' %
+         (int(duration * fps), width, height, fps, ENCODERS[encoder], fname))
+    pipeline = Gst.parse_launch(s)
+    pipeline.set_state(Gst.State.PLAYING)
+    msg = pipeline.get_bus().timed_pop_filtered(Gst.CLOCK_TIME_NONE,
+                                                Gst.MessageType.EOS |
+                                                Gst.MessageType.ERROR)
+    pipeline.set_state(Gst.State.NULL)
+    if msg.type == Gst.MessageType.ERROR:
+        raise RuntimeError('Making %s failed: %s' % (fname,
+                                                     msg.parse_error()))
+
+
+def _peak_rss_mb():
+    """
+    Peak resident set size of this process in MB.
+    """
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _percentiles(x):
+    x = np.asarray(x)
+    return {'p50': float(np.percentile(x, 50)),
+            'p90': float(np.percentile(x, 90)),
+            'p99': float(np.percentile(x, 99)),
+            'max': float(x.max())}
+
+
+def bench_reader(fname, n_seeks=100, seed=0):
+    """
+    Measures VideoReader open latency, get_frame seek latency percentiles,
+    sequential frames per second and peak RSS. Run it in a child process,
+    see run_isolated.
+    """
+    t0 = time.perf_counter()
+    vr = VideoReader(fname)
+    open_s = time.perf_counter() - t0
+
+    rng = np.random.RandomState(seed)
+    times = rng.uniform(0, vr.duration_seconds - 2 * vr.dt_ns * 1e-9,
+                        n_seeks)
+    seek_s = []
+    for t in times:
+        t0 = time.perf_counter()
+        vr.get_frame(t)
+        seek_s.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    n_frames = 0
+    for t, frame in vr.iter_frames(copy=False):
+        n_frames += 1
+    seq_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    vr.get_frames(times)
+    batch_s = time.perf_counter() - t0
+    vr.close()
+
+    return {'open_ms': 1e3 * open_s,
+            'seek_ms': {k: 1e3 * v for k, v in _percentiles(seek_s).items()},
+            'sequential_fps': n_frames / seq_s,
+            'n_frames': n_frames,
+            'batch_get_frames_ms': 1e3 * batch_s,
+            'peak_rss_mb': _peak_rss_mb()}
+
+
+def bench_webcam(workdir, writeenc='theora', srcenc='raw', fps=30,
+                 duration=5.0, draw_timestamp=True, width=640, height=480,
+                 display=False):
+    """
+    Measures a Webcam recording pipeline fed from videotestsrc: achieved
+    frame rate, CPU time per second of recording and peak RSS. Run it in a
+    child process, see run_isolated.
+    """
+    video_fname = os.path.join(workdir, 'webcam_%s_%s.mkv' %
+                               (srcenc, writeenc))
+    src = video_tools.test_source_description(srcenc, width=width,
+                                              height=height, fps=fps)
+    cam = Webcam(video_fname=video_fname,
+                 fps=fps,
+                 display=display,
+                 srcenc=srcenc,
+                 writeenc=writeenc,
+                 draw_timestamp=draw_timestamp,
+                 verbose=False,
+                 video_src=src,
+                 display_sink='fakesink sync=false',
+                 width=width,
+                 height=height)
+
+    cpu0 = time.process_time()
+    t0 = time.perf_counter()
+    cam.run()
+    time.sleep(duration)
+    cam.close()
+    wall_s = time.perf_counter() - t0
+    cpu_s = time.process_time() - cpu0
+
+    return {'fps': cam.n_frames / wall_s,
+            'target_fps': fps,
+            'cpu_s_per_s': cpu_s / wall_s,
+            'dropped_records': cam.ts_log.n_dropped,
+            'peak_rss_mb': _peak_rss_mb()}
+
+
+def bench_encode(encoder='x264', profile='realtime', width=1280, height=720,
+                 fps=30, n_frames=300):
+    """
+    Measures encoding speed and CPU cost of an encoder tuning profile, see
+    video_tools.ENCODER_PROFILES, on videotestsrc frames pushed as fast as
+    the encoder takes them. Run it in a child process, see run_isolated.
+    """
+    video_tools._init_gst()
+    Gst = video_tools.Gst
+    element = ENCODERS[encoder].split()[0]
+    props = video_tools.encoder_properties(element, profile)
+    s = ('videotestsrc num-buffers=%d pattern=ball '
+         '! video/x-raw, width=%d, height=%d, framerate=%d/1 '
+         '! videoconvert ! %s name=enc ! fakesink name=sink sync=false' %
+         (n_frames, width, height, fps, element))
+    pipeline = Gst.parse_launch(s)
+    video_tools._set_properties(pipeline.get_by_name('enc'), props)
+    n_bytes = [0]
+
+    def on_buffer(pad, info):
+        n_bytes[0] += info.get_buffer().get_size()
+        return Gst.PadProbeReturn.OK
+
+    pipeline.get_by_name('sink').get_static_pad('sink').add_probe(
+        Gst.PadProbeType.BUFFER, on_buffer)
+
+    cpu0 = time.process_time()
+    t0 = time.perf_counter()
+    pipeline.set_state(Gst.State.PLAYING)
+    msg = pipeline.get_bus().timed_pop_filtered(Gst.CLOCK_TIME_NONE,
+                                                Gst.MessageType.EOS |
+                                                Gst.MessageType.ERROR)
+    wall_s = time.perf_counter() - t0
+    cpu_s = time.process_time() - cpu0
+    pipeline.set_state(Gst.State.NULL)
+    if msg.type == Gst.MessageType.ERROR:
+        raise RuntimeError('Encoding failed: %s' % (msg.parse_error(),))
+
+    return {'encode_fps': n_frames / wall_s,
+            'cpu_ms_per_frame': 1e3 * cpu_s / n_frames,
+            # CPU cores used when encoding in real time at fps
+            'cores_at_fps': cpu_s / n_frames * fps,
+            'kbit_per_s': 8e-3 * n_bytes[0] / (n_frames / fps),
+            'peak_rss_mb': _peak_rss_mb()}
+
+
+def run_isolated(func, *args, **kwargs):
+    """
+    Runs func(*args, **kwargs) in a fresh process and returns its result.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        return pool.apply(func, args, kwargs)
+
+
+def bench_import():
+    """
+    Import times of video_tools and video_player, see check_import_time.
+    """
+    from check_import_time import import_time
+    return {module: import_time(module)
+            for module in ('video_tools', 'video_player')}
+
+
+def _environment():
+    video_tools._init_gst()
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'gstreamer': video_tools.Gst.version_string(),
+            'numpy': np.__version__,
+            'n_cpus': os.cpu_count(),
+            'commit': commit}
+
+
+def run(workdir, encoders=('theora', 'vp8', 'x264'), sizes=SIZES,
+        duration=10.0, fps=30, n_seeks=100,
+        profiles=('realtime', 'balanced', 'archival')):
+    """
+    Runs all benchmarks and returns the results as a dict.
+    """
+    results = {'environment': _environment(), 'benchmarks': []}
+
+    def add(name, params, metrics):
+        results['benchmarks'].append({'name': name,
+                                      'params': params,
+                                      'metrics': metrics})
+        print('%s %s: %s' % (name, json.dumps(params), json.dumps(metrics)))
+
+    add('import', {}, bench_import())
+
+    for encoder in encoders:
+        for width, height in sizes:
+            fname = os.path.join(workdir, 'test_%s_%dx%d.mkv' %
+                                 (encoder, width, height))
+            if not os.path.isfile(fname):
+                make_test_video(fname, encoder, width, height, fps, duration)
+            params = {'encoder': encoder, 'width': width, 'height': height,
+                      'fps': fps, 'duration': duration}
+            add('reader', params, run_isolated(bench_reader, fname, n_seeks))
+
+    for srcenc in ('raw', 'mjpeg'):
+        for writeenc in list(encoders) + ['passthrough']:
+            params = {'srcenc': srcenc, 'writeenc': writeenc, 'fps': fps}
+            add('webcam', params,
+                run_isolated(bench_webcam, workdir, writeenc, srcenc, fps))
+
+    for encoder in encoders:
+        for profile in profiles:
+            width, height = sizes[-1]
+            params = {'encoder': encoder, 'profile': profile,
+                      'width': width, 'height': height, 'fps': fps}
+            add('encode', params,
+                run_isolated(bench_encode, encoder, profile, width, height,
+                             fps))
+
+    return results
+
+
+def _flatten(d, prefix=''):
+    out = {}
+    for k, v in d.items():
+        if isinstance(v, dict):
+            out.update(_flatten(v, '%s%s.' % (prefix, k)))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out['%s%s' % (prefix, k)] = v
+    return out
+
+
+# Metrics where larger is better, all others are times or sizes
+_HIGHER_IS_BETTER = ('fps', 'sequential_fps', 'encode_fps')
+
+
+def compare(old, new, tolerance=0.1):
+    """
+    Compares two result dicts from run() and returns a list of regressions,
+    metrics that got worse by more than tolerance (relative).
+    """
+    def key(b):
+        return b['name'], json.dumps(b['params'], sort_keys=True)
+
+    old_metrics = {key(b): _flatten(b['metrics']) for b in old['benchmarks']}
+    regressions = []
+    for b in new['benchmarks']:
+        if not key(b) in old_metrics:
+            continue
+        before = old_metrics[key(b)]
+        for name, value in _flatten(b['metrics']).items():
+            if not name in before or not before[name]:
+                continue
+            change = (value - before[name]) / abs(before[name])
+            if name.split('.')[-1] in _HIGHER_IS_BETTER:
+                change = -change
+            if change > tolerance:
+                regressions.append({'name': b['name'],
+                                    'params': b['params'],
+                                    'metric': name,
+                                    'old': before[name],
+                                    'new': value,
+                                    'change': change})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--out', default='bench_results.json',
+                        help='output JSON file')
+    parser.add_argument('--workdir', default=None,
+                        help='directory for the test videos '
+                             '(default: a temporary directory)')
+    parser.add_argument('--encoders', default='theora,vp8,x264')
+    parser.add_argument('--sizes', default=','.join('%dx%d' % s
+                                                    for s in SIZES))
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='duration of the test videos in seconds')
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--seeks', type=int, default=100)
+    parser.add_argument('--profiles', default='realtime,balanced,archival',
+                        help='encoder profiles of the encode benchmark, '
+                             'run at the largest size')
+    parser.add_argument('--compare', default=None,
+                        help='earlier results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    encoders = args.encoders.split(',')
+    sizes = [tuple(int(x) for x in s.split('x'))
+             for s in args.sizes.split(',')]
+
+    if args.workdir is None:
+        tmp = tempfile.TemporaryDirectory()
+        workdir = tmp.name
+    else:
+        workdir = args.workdir
+        os.makedirs(workdir, exist_ok=True)
+
+    results = run(workdir, encoders, sizes, args.duration, args.fps,
+                  args.seeks, args.profiles.split(','))
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('Results written to %s' % args.out)
+
+    if not args.compare is None:
+        with open(args.compare, 'r') as f:
+            old = json.load(f)
+        regressions = compare(old, results, args.tolerance)
+        for r in regressions:
+            print('REGRESSION %s %s %s: %0.4g -> %0.4g (%+0.0f%%)' %
+                  (r['name'], json.dumps(r['params']), r['metric'],
+                   r['old'], r['new'], 100 * r['change']))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
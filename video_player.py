@@ -5,84 +5,236 @@ Created on Wed Oct  5 13:59:40 2016
 @author: hjalmar
 """
 
-import matplotlib
-matplotlib.use('TkAgg')
 import warnings
-from matplotlib import pyplot as plt
-from matplotlib import patches
-from video_tools import VideoReader
+from video_tools import VideoReader, _attach_shared_memory
 import numpy as np
 import time
 import os
-from multiprocessing import Process, Pipe
+from collections import deque
+from multiprocessing import Process, Pipe, shared_memory
 
+# matplotlib is imported, and the TkAgg backend set, when the first
+# VideoPlayer is created, see _init_matplotlib().
+plt = None
+patches = None
+
+
+def _init_matplotlib():
+    """
+    Imports matplotlib with the TkAgg backend, once.
+    """
+    global plt, patches
+    if not plt is None:
+        return
+    import matplotlib
+    matplotlib.use('TkAgg')
+    from matplotlib import patches
+    from matplotlib import pyplot as plt
 
-class DataPump:
 
-    def __init__(self, fname, t0=0.0):
+class DataPump:
+    """
+    Reads frames in a separate process. Frames are passed in a ring of
+    preallocated slots in shared memory, written by the reader process with
+    VideoReader.get_frame(out=slot). Only slot indices and times go over the
+    pipe, so frames are not pickled and copied through it.
+
+    The reader keeps up to read_ahead frames decoded ahead of playback, at
+    the times that will be asked for next if playback goes on in steps of
+    step seconds. When step changes, i.e. the playback direction, the
+    frames read ahead are discarded.
+    """
+
+    def __init__(self, fname, t0=0.0, cache_bytes=0, read_ahead=4):
         """
+        fname       -- video filename (str)
+        t0          -- time of first frame (float)
+        cache_bytes -- memory budget of the VideoReader frame cache (int)
+        read_ahead  -- number of frames decoded ahead of playback (int)
         """
         self.fname = fname
+        self.cache_bytes = cache_bytes
+        self.read_ahead = read_ahead
+        # One slot per frame read ahead, one for the frame asked for and
+        # one for the frame returned last
+        self.n_slots = read_ahead + 2
+        self.shm = None
+        self.frames = None
+        self._free = list(range(self.n_slots))
+        self._pending = deque()  # (time, slot) of frames asked for
+        self._shown = None  # slot of the frame returned last
+        self._gen = 0  # incremented when the frames read ahead are discarded
         self._data_end, self._control_end = Pipe()
         self.process = Process(target=self._read_data, args=())
         self.process.start()
-        self._control_end.send((True, t0))
         if self._control_end.poll(5.):
-            self.dt = self._control_end.recv()
+            self.dt, self.duration, frame_shape = self._control_end.recv()
+            nbytes = self.n_slots * int(np.prod(frame_shape))
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.frames = np.ndarray((self.n_slots,) + tuple(frame_shape),
+                                     dtype=np.uint8, buffer=self.shm.buf)
+            self._control_end.send(self.shm.name)
         else:
             warnings.warn("dt could not be retrived from video, waited 5 s",
                           RuntimeWarning)
             self.dt = np.nan
+            self.duration = np.inf
+        self._step = self.dt
+        self._request(t0)
+        self._fill_window()
 
     def _read_data(self):
         """
+        Reader process. Reads the requested frames into their slots, in
+        order. Requests of an older generation than the newest one received
+        are not read, only their slots are sent back.
         """
 
-        vr = VideoReader(self.fname, color=False)
-        self._data_end.send(vr.dt_ns * 1e-9)
+        vr = VideoReader(self.fname, color=False, cache_bytes=self.cache_bytes)
+        self._data_end.send((vr.dt_ns * 1e-9, vr.duration_seconds,
+                             vr.frame_shape))
+        shm = _attach_shared_memory(self._data_end.recv())
+        frames = np.ndarray((self.n_slots,) + vr.frame_shape,
+                            dtype=np.uint8, buffer=shm.buf)
+        todo = deque()
+        gen = 0
         running = True
 
         while running:
-
-            if self._data_end.poll():   # See if msg sent from get_data
-                running, next_t = self._data_end.recv()   # get the time of the frame to read (from get_data)
-                if running:
-                    data = vr.get_frame(next_t)  # Read video frame
-                    curr_t = vr.get_current_position(fmt='time')  # get time of frame from video, should be very close to self.data_t
-                    self._data_end.send((data, curr_t))  # Send data via the pipe to get_data
-
+            # Block for requests only when there is nothing to read
+            while running and (not todo or self._data_end.poll()):
+                msg = self._data_end.recv()
+                if msg[0] == 'stop':
+                    running = False
+                    break
+                _, msg_gen, next_t, slot = msg
+                if msg_gen > gen:
+                    gen = msg_gen
+                    # Discarded, give back the slots unread
+                    while todo:
+                        old_gen, _, old_slot = todo.popleft()
+                        self._data_end.send((old_gen, old_slot, None))
+                todo.append((msg_gen, next_t, slot))
+            if running and todo:
+                msg_gen, next_t, slot = todo.popleft()
+                frame = vr.get_frame(next_t, out=frames[slot])  # Read video frame into its slot
+                curr_t = vr.get_current_position(fmt='time')  # get time of frame from video, should be very close to next_t
+                if frame is None:
+                    curr_t = None
+                self._data_end.send((msg_gen, slot, curr_t))
+
+        del frames
+        shm.close()
         vr.close()
 
-    def get_data(self, next_t):
+    def _request(self, t):
         """
-        Ask for a future frame and returns the previously asked for.
+        Asks the reader process for the frame at time t, into a free slot.
+        """
+        while not self._free:
+            # Only slots of discarded requests can be on their way back
+            self._recv()
+        slot = self._free.pop()
+        self._control_end.send(('read', self._gen, t, slot))
+        self._pending.append((t, slot))
+
+    def _recv(self):
+        """
+        Receives the next frame read, returns (slot, frame time) or None if
+        it belonged to discarded requests. Then its slot is freed.
         """
-        # Get previous frame and time of frame via the pipe from self._read_data
-        data, curr_t = self._control_end.recv()
-        # Tell self._read_data to read a new frame at time next_t
-        self._control_end.send((True, next_t))
+        gen, slot, curr_t = self._control_end.recv()
+        if gen != self._gen:
+            self._free.append(slot)
+            return None
+        self._pending.popleft()
+        return slot, curr_t
+
+    def _fill_window(self):
+        """
+        Asks for the frames following the last one asked for, up to
+        read_ahead frames ahead, as long as there are free slots and frames
+        in the video.
+        """
+        while len(self._pending) <= self.read_ahead and self._free:
+            t = self._pending[-1][0] + self._step
+            if t < 0.0 or t >= self.duration:  # no frames outside the video
+                break
+            self._request(t)
+
+    def get_data(self, next_t, step=None):
+        """
+        Ask for a future frame and returns the previously asked for.
 
-        return data, curr_t
+        next_t -- time of the frame to return on the next call (float)
+        step   -- time step (s) between the frames of the next calls,
+                  negative when playing backwards. Default: the frame
+                  duration, i.e. forward.
+
+        The frame returned is a view of a shared memory slot, valid until
+        the next call.
+        """
+        if step is None:
+            step = self.dt
+        # Get the slot of the previous frame and its time from self._read_data
+        ret = None
+        while ret is None:
+            ret = self._recv()
+        slot, curr_t = ret
+        if not self._shown is None:
+            self._free.append(self._shown)
+        self._shown = slot
+
+        # Discard the frames read ahead if playback changed direction or
+        # jumped
+        if step != self._step or not self._pending or \
+                abs(self._pending[0][0] - next_t) > 0.5 * abs(self.dt):
+            self._gen += 1
+            self._pending.clear()
+            self._step = step
+            self._request(next_t)
+        self._fill_window()
+
+        if curr_t is None:
+            return None, None
+        return self.frames[slot], curr_t
 
     def close(self):
         """
         """
-        self._control_end.send((False, None))
+        self._control_end.send(('stop',))
+        self.process.join()
         self._control_end.close()
         self._data_end.close()
-        self.process.join()
+        if not self.shm is None:
+            self.frames = None
+            self.shm.unlink()
+            try:
+                self.shm.close()
+            except BufferError:
+                # A returned frame is still in use, e.g. by the image. The
+                # memory is released together with it instead.
+                pass
 
 
 class VideoPlayer:
 
-    def __init__(self, fname, t0=0.0, fig_h=6., dpi=85):
+    def __init__(self, fname, t0=0.0, fig_h=6., dpi=85, cache_bytes=256*2**20,
+                 read_ahead=4):
         """
+        cache_bytes -- memory budget of the decoded frame cache, so that
+                       frames are not decoded again when scrubbing back and
+                       forth. Default 256 MB.
+        read_ahead  -- number of frames decoded ahead in the playback
+                       direction, see DataPump. Default 4.
         """
         if not os.path.isfile(fname):
             raise FileNotFoundError('No such file: %s' % fname)
 
+        _init_matplotlib()
         plt.ion()
-        self.dp = DataPump(fname, t0=t0)
+        self.dp = DataPump(fname, t0=t0, cache_bytes=cache_bytes,
+                           read_ahead=read_ahead)
         self.data, self.data_t = self.dp.get_data(t0)
         self.data_dt = self.dp.dt
         self.data_fps = 1 / self.data_dt
@@ -179,10 +331,13 @@ class VideoPlayer:
             else:
 
                 # np.sign() takes care of the playback direction (forward or backward)
-                data_t1 += self.data_dt * np.sign(self.requested_fps)
+                step = self.data_dt * np.sign(self.requested_fps)
+                data_t1 += step
 
                 if data_t1 > 0.0: # no frames at negative times
-                    self.data, self.data_t = self.dp.get_data(data_t1)
+                    self.data, self.data_t = self.dp.get_data(data_t1, step)
+                    if self.data is None:  # e.g. past the end of the video
+                        break
                     self.text.set_text('t = %1.2fs' % self.data_t)
                     fps = self.data_fps * ((data_t1 - self.data_t) / dt)
                     self.im.set_data(self.data)
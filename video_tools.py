@@ -5,25 +5,80 @@ Created on Thu Oct  7 15:32:44 2014
 @author: Hjalmar K. Turesson
 """
 import os
+import json
 import numpy as np
 from datetime import datetime
 import time
 import pathlib
+import bisect
+import threading
+import queue
+from contextlib import contextmanager
+from fractions import Fraction
+import multiprocessing
+from multiprocessing import shared_memory
+from collections import OrderedDict, deque
 from glob import glob
-# Setting GST_DEBUG_DUMP_DOT_DIR environment variable enables us to  have a
-#  dotfile generated. The environment variable cannot be set inside the class.
-os.environ["GST_DEBUG_DUMP_DOT_DIR"] = "/tmp"
-# GStreamer imports
-import gi
-gi.require_version('Gst', '1.0')
-gi.require_version('GstPbutils', '1.0')
-#gi.require_version('Gtk', '3.0')
-from gi.repository import GObject, Gst
-Gst.init(None)
-Gst.debug_set_active(False)
-Gst.debug_set_default_threshold(0)
-from gi.repository import GstPbutils
-#GObject.threads_init()
+
+# GStreamer is imported and initialized on first use, by _init_gst(), so
+# that importing this module is fast. Code that only reads timestamp logs
+# or frame indices never loads it.
+Gst = None
+GstPbutils = None
+GstVideo = None
+_gst_lock = threading.Lock()
+
+
+def _init_gst():
+    """
+    Imports and initializes GStreamer, once. Called by everything that
+    builds pipelines or otherwise needs GStreamer.
+    """
+    global Gst, GstPbutils, GstVideo
+    if not Gst is None:
+        return
+    with _gst_lock:
+        if not Gst is None:
+            return
+        # Setting GST_DEBUG_DUMP_DOT_DIR environment variable enables us to
+        # have a dotfile generated. It has to be set before Gst.init().
+        os.environ.setdefault("GST_DEBUG_DUMP_DOT_DIR", "/tmp")
+        import gi
+        gi.require_version('Gst', '1.0')
+        gi.require_version('GstPbutils', '1.0')
+        gi.require_version('GstVideo', '1.0')
+        from gi.repository import Gst as _Gst
+        _Gst.init(None)
+        _Gst.debug_set_active(False)
+        _Gst.debug_set_default_threshold(0)
+        from gi.repository import GstPbutils, GstVideo
+        Gst = _Gst
+
+
+def _video_info_from_caps(caps):
+    """
+    Returns a GstVideo.VideoInfo, with plane strides and offsets, from caps.
+    """
+    if hasattr(GstVideo.VideoInfo, 'new_from_caps'):  # GStreamer >= 1.20
+        return GstVideo.VideoInfo.new_from_caps(caps)
+    vinfo = GstVideo.VideoInfo()
+    vinfo.from_caps(caps)
+    return vinfo
+
+
+def _map_buffer(buf):
+    """
+    Maps a Gst.Buffer for reading. Returns the Gst.MapInfo or None on failure.
+    gst-python overrides return the MapInfo directly, plain gi a tuple.
+    """
+    ret = buf.map(Gst.MapFlags.READ)
+    if isinstance(ret, tuple):
+        ok, mapinfo = ret
+        if not ok:
+            return None
+        return mapinfo
+    return ret
+
 
 def list_connected_cameras():
     """
@@ -38,52 +93,65 @@ def get_file_info(fname, verbose=False):
     See:
     http://stackoverflow.com/questions/11324519/how-do-i-use-the-discoverer-module-with-pygi-gstpbutils
 
+    For many files use get_files_info, which is concurrent and caches the
+    results.
+
     Hjalmar K. Turesson, 2016-09-22
     """
-
-    def on_discovered(discoverer, ismedia, infile):
-        pass
+    _init_gst()
 
     discoverer = GstPbutils.Discoverer()
-    discoverer.connect('discovered', on_discovered)
     uri = pathlib.Path(fname).as_uri()
     info = discoverer.discover_uri(uri)
 
+    return _parse_discoverer_info(info, verbose=verbose)
+
+
+def _parse_discoverer_info(info, verbose=False):
+    """
+    Returns the video_info dict and audio_info list of get_file_info from a
+    GstPbutils.DiscovererInfo. Caps fields are read as typed values from the
+    caps structure.
+    """
     video_info = {'format': '--',
                   'format_version': '--',
                   'format_specification': '--',
                   'width': -1,
                   'height': -1,
-                  'fps': -1}
+                  'fps': -1,
+                  'duration': info.get_duration() / Gst.SECOND}
 
     # video info
     vstreams = info.get_video_streams()
     if len(vstreams) == 1:
-        vcaps = vstreams[0].get_caps().to_string()
+        vcaps = vstreams[0].get_caps()
         if verbose:
             print('Video info:')
-            print(vcaps)
-
-        vcaps = vcaps.split(',')
-
-        for prop in vcaps:
-            if 'video/' in prop:
-                video_info['format'] = prop
-            elif 'version=' in prop:
-                video_info['format_version'] = prop.split(')')[-1]
-            elif 'format=' in prop:
-                video_info['format_specification'] = prop.split(')')[-1]
-            elif 'width=' in prop:
-                video_info['width'] = int(prop.split(')')[-1])
-            elif 'height=' in prop:
-                video_info['height'] = int(prop.split(')')[-1])
-            elif 'framerate=' in prop:
-                if 'fraction' in prop:
-                    video_info['fps'] = eval(prop.split(')')[-1])
-                elif 'in' in prop:
-                    video_info['fps'] = int(prop.split(')')[-1])
-                else:
-                    video_info['fps'] = prop.split(')')[-1]
+            print(vcaps.to_string())
+
+        st = vcaps.get_structure(0)
+        video_info['format'] = st.get_name()
+        for i in range(st.n_fields()):
+            field = st.nth_field_name(i)
+            # E.g. mpegversion
+            if field.endswith('version'):
+                video_info['format_version'] = str(st.get_value(field))
+        # The pixel format of raw video, or e.g. the stream-format of h264,
+        # but not chroma-format
+        for field in ('format', 'stream-format'):
+            if st.has_field(field):
+                video_info['format_specification'] = str(st.get_value(field))
+                break
+
+        ok, width = st.get_int('width')
+        if ok:
+            video_info['width'] = width
+        ok, height = st.get_int('height')
+        if ok:
+            video_info['height'] = height
+        ok, num, den = st.get_fraction('framerate')
+        if ok and den:
+            video_info['fps'] = num / den
     else:
         print('%d video streams found, expected 1' % len(vstreams))
 
@@ -109,31 +177,695 @@ def get_file_info(fname, verbose=False):
     return video_info, audio_info
 
 
+def get_files_info(fnames, n_workers=8, cache_fname=None, timeout=10.0):
+    """
+    Gets info, as get_file_info, from many video files.
+
+    Files are discovered concurrently by n_workers threads, each with its own
+    discoverer. With cache_fname, the results are saved to a JSON file,
+    keyed by path and stored with the size and modification time of the
+    file. Unchanged files are then read from the cache instead of being
+    discovered again.
+
+    Parameters
+    ----------
+    fnames      -- video filenames (list of str)
+    n_workers   -- number of concurrent discoverers (int)
+    cache_fname -- filename of the JSON cache (str). Default None, no cache.
+    timeout     -- timeout, in seconds, of discovering one file (float)
+
+    Returns
+    -------
+    info        -- dict with (video_info, audio_info) per filename.
+                   (None, None) for files that could not be discovered.
+    """
+    _init_gst()
+    from concurrent.futures import ThreadPoolExecutor
+
+    cache = {}
+    if not cache_fname is None and os.path.isfile(cache_fname):
+        with open(cache_fname, 'r') as f:
+            cache = json.load(f)
+
+    info = {}
+    to_discover = []
+    for fname in fnames:
+        key = os.path.abspath(fname)
+        try:
+            st = os.stat(fname)
+        except OSError as err:
+            print('Discovering %s failed: %s' % (fname, err))
+            info[fname] = (None, None)
+            continue
+        entry = cache.get(key)
+        if (not entry is None and entry['size'] == st.st_size and
+            entry['mtime'] == st.st_mtime):
+            info[fname] = (entry['video_info'], entry['audio_info'])
+        else:
+            to_discover.append((fname, key, st))
+
+    local = threading.local()
+
+    def discover(fname):
+        if not hasattr(local, 'discoverer'):
+            local.discoverer = GstPbutils.Discoverer.new(int(timeout *
+                                                             Gst.SECOND))
+        try:
+            res = local.discoverer.discover_uri(pathlib.Path(fname).as_uri())
+        except Exception as err:
+            print('Discovering %s failed: %s' % (fname, err))
+            return None, None
+        return _parse_discoverer_info(res)
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        results = pool.map(discover, [d[0] for d in to_discover])
+        for (fname, key, st), (video_info, audio_info) in zip(to_discover,
+                                                              results):
+            info[fname] = (video_info, audio_info)
+            if not video_info is None:
+                cache[key] = {'size': st.st_size,
+                              'mtime': st.st_mtime,
+                              'video_info': video_info,
+                              'audio_info': audio_info}
+
+    if not cache_fname is None and len(to_discover):
+        # Write to a temporary file first, so that the cache is never left
+        # half written.
+        tmp_fname = '%s.tmp' % cache_fname
+        with open(tmp_fname, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_fname, cache_fname)
+
+    return info
+
+
+# Binary timestamp logs start with this magic, followed by the length of a
+# JSON header (uint32, little endian), the JSON header with the record dtype
+# and metadata, padding to a multiple of 64 bytes, and the records.
+_TSLOG_MAGIC = b'VTTSLOG1'
+
+# Records of the timestamp logs written by Webcam: frame number, buffer pts
+# (s), Python clock (s) and the number of frames missing before this one,
+# judged from the gap in pts.
+_tslog_dtype = np.dtype([('frame_n', '<i8'),
+                         ('buf_ts', '<f8'),
+                         ('py_ts', '<f8'),
+                         ('n_missing', '<i4')])
+
+
+class TextTimestampLog:
+    """
+    Writes a timestamp log as text, one comma separated line per record.
+    """
+
+    def __init__(self, fname, header='', fmt='%d,%0.9f,%0.9f\n',
+                 flag_gaps=False):
+        """
+        fname     -- log filename (str)
+        header    -- text written first (str)
+        fmt       -- format of a record line (str)
+        flag_gaps -- if True, the last field of the records is the number of
+                     missing frames before it, written as a comment line,
+                     '# N frames missing', when not 0. Comment lines are
+                     skipped by the readers, and by np.loadtxt.
+        """
+        self.fname = fname
+        self.fmt = fmt
+        self.flag_gaps = flag_gaps
+        self.f = open(fname, 'w')
+        self.f.write(header)
+
+    def write(self, *record):
+        if self.flag_gaps:
+            if record[-1]:
+                self.f.write('# %d frames missing\n' % record[-1])
+            record = record[:-1]
+        self.f.write(self.fmt % record)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class BinaryTimestampLog:
+    """
+    Writes a timestamp log as fixed size binary records, see
+    load_timestamp_log. Records are collected in a preallocated array and
+    written batch_size records at a time.
+    """
+
+    def __init__(self, fname, meta=None, dtype=_tslog_dtype, batch_size=256):
+        """
+        fname      -- log filename (str)
+        meta       -- metadata saved in the header, e.g. the video filename
+                      and start time (dict of JSON serializable values)
+        dtype      -- record dtype
+        batch_size -- number of records written at a time (int)
+        """
+        self.fname = fname
+        self.dtype = np.dtype(dtype)
+        self._batch = np.zeros(batch_size, dtype=self.dtype)
+        self._n = 0
+        self.f = open(fname, 'wb')
+
+        header = json.dumps({'dtype': self.dtype.descr,
+                             'meta': {} if meta is None else meta})
+        header = header.encode('utf-8')
+        # Records start at a multiple of 64 bytes
+        n = len(_TSLOG_MAGIC) + 4 + len(header)
+        header += b' ' * (-n % 64)
+        self.f.write(_TSLOG_MAGIC)
+        self.f.write(np.uint32(len(header)).astype('<u4').tobytes())
+        self.f.write(header)
+
+    def write(self, *record):
+        self._batch[self._n] = record
+        self._n += 1
+        if self._n == len(self._batch):
+            self.flush()
+
+    def flush(self):
+        if self._n:
+            self.f.write(self._batch[:self._n].tobytes())
+            self._n = 0
+        self.f.flush()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+def is_binary_timestamp_log(fname):
+    """
+    Whether fname is a binary timestamp log.
+    """
+    with open(fname, 'rb') as f:
+        return f.read(len(_TSLOG_MAGIC)) == _TSLOG_MAGIC
+
+
+def _read_binary_header(f):
+    """
+    Reads the header of a binary timestamp log from f, opened in binary
+    mode, and leaves f at the first record. Returns the record dtype and
+    the metadata.
+    """
+    f.seek(len(_TSLOG_MAGIC))
+    n = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+    header = json.loads(f.read(n).decode('utf-8'))
+    dtype = np.dtype([tuple(field) for field in header['dtype']])
+    return dtype, header['meta']
+
+
+def load_timestamp_log(fname):
+    """
+    Loads a timestamp log.
+
+    Binary logs are memory mapped, so loading takes the same, short, time
+    whatever the length of the log. Text logs are parsed, see
+    convert_timestamp_log to convert them.
+
+    Returns
+    -------
+    records -- numpy structured array, one record per frame
+    meta    -- dict with the metadata of the log header
+    """
+    if not is_binary_timestamp_log(fname):
+        return _read_text_timestamp_log(fname)
+
+    with open(fname, 'rb') as f:
+        dtype, meta = _read_binary_header(f)
+        offset = f.tell()
+
+    n_records = (os.path.getsize(fname) - offset) // dtype.itemsize
+    if n_records == 0:
+        return np.zeros(0, dtype=dtype), meta
+    records = np.memmap(fname, dtype=dtype, mode='r', offset=offset,
+                        shape=(n_records,))
+    return records, meta
+
+
+def _read_text_header(lines):
+    """
+    Parses the header lines of a text timestamp log, those before the first
+    record or comment line. Returns the metadata and the number of header
+    lines.
+    """
+    meta = {}
+    n_header = 0
+    for line in lines:
+        if line.startswith('#'):
+            break
+        try:
+            int(line.split(',')[0])
+            break
+        except ValueError:
+            pass
+        n_header += 1
+        line = line.strip()
+        if line.startswith('frame_number') or line.startswith('n_buf'):
+            meta['columns'] = line
+            continue
+        for item in line.split(', '):
+            if ': ' in item:
+                key, value = item.split(': ', 1)
+                meta[key] = value
+    return meta, n_header
+
+
+def _read_text_timestamp_log(fname):
+    """
+    Parses a text timestamp log, as written by Webcam, Webcam_h264 or the
+    minimal classes. The header lines go into meta and the record fields
+    are named according to the number of columns. The n_missing field is
+    rebuilt from the '# N frames missing' lines, so that the records of a
+    Webcam log have the dtype of its binary logs, _tslog_dtype.
+    """
+    rows = []
+    n_missing = []
+    gap = 0
+    with open(fname, 'r') as f:
+        meta, n_header = _read_text_header(f)
+        f.seek(0)
+        for i, line in enumerate(f):
+            if i < n_header:
+                continue
+            line = line.strip()
+            if line.startswith('#'):
+                fields = line[1:].split()
+                if len(fields) == 3 and fields[1:] == ['frames', 'missing']:
+                    gap += int(fields[0])
+                continue
+            try:
+                row = [float(x) for x in line.split(',')]
+            except ValueError:
+                # e.g. an empty line, or the last line cut by a crash
+                continue
+            if rows and len(row) != len(rows[0]):
+                continue
+            rows.append(row)
+            n_missing.append(gap)
+            gap = 0
+
+    n_cols = len(rows[0]) if rows else 3
+    if n_cols == 3:  # Webcam
+        dtype = _tslog_dtype
+    else:
+        if n_cols == 4:  # Webcam_h264
+            names = ['frame_n', 'offset_ts', 'buf_ts', 'py_ts']
+        else:
+            names = ['frame_n', 'buf_ts', 'py_ts'][:n_cols]
+        dtype = np.dtype([(name, _tslog_dtype['py_ts'] if i else '<i8')
+                          for i, name in enumerate(names)] +
+                         [('n_missing', _tslog_dtype['n_missing'])])
+    records = np.zeros(len(rows), dtype=dtype)
+    if rows:
+        data = np.array(rows)
+        for i, name in enumerate(dtype.names[:n_cols]):
+            records[name] = data[:, i]
+        records['n_missing'] = n_missing
+    return records, meta
+
+
+def convert_timestamp_log(txt_fname, bin_fname=None):
+    """
+    Converts a text timestamp log to a binary one.
+
+    Parameters
+    ----------
+    txt_fname -- filename of the text log
+    bin_fname -- filename of the binary log. Default: txt_fname + '.bin'
+
+    Returns
+    -------
+    bin_fname
+    """
+    if bin_fname is None:
+        bin_fname = '%s.bin' % txt_fname
+    records, meta = _read_text_timestamp_log(txt_fname)
+    log = BinaryTimestampLog(bin_fname, meta=meta, dtype=records.dtype)
+    log.f.write(records.tobytes())
+    log.close()
+    return bin_fname
+
+
+def _segment_manifest_fname(video_fname):
+    """
+    Filename of the segment manifest of a segmented recording.
+    """
+    return '%s_segments.json' % video_fname[:-4]
+
+
+def load_segment_manifest(fname):
+    """
+    Loads the manifest of a segmented recording, see Webcam
+    segment_duration. It is a dict with the session video filename and
+    'segments', a list of dicts with the segment filename 'fname', and
+    'start_ts' and 'end_ts', the capture pts (s) of its first and last
+    frames, as logged in the buf_ts column of the timestamp log.
+
+    fname -- filename of the manifest, or of the session video
+    """
+    if fname.endswith('.mkv'):
+        fname = _segment_manifest_fname(fname)
+    with open(fname, 'r') as f:
+        return json.load(f)
+
+
+def segment_for_time(manifest, t):
+    """
+    Finds the segment of a segmented recording holding capture time t.
+
+    Parameters
+    ----------
+    manifest -- dict from load_segment_manifest, or its filename
+    t        -- capture pts (s), i.e. the buf_ts of the timestamp log
+
+    Returns
+    -------
+    fname -- segment filename, None if t is before the first segment
+    t_seg -- t relative to the start of the segment, for
+             VideoReader.get_frame
+    """
+    if isinstance(manifest, str):
+        manifest = load_segment_manifest(manifest)
+    starts = [seg['start_ts'] for seg in manifest['segments']]
+    i = bisect.bisect_right(starts, t) - 1
+    if i < 0:
+        return None, None
+    seg = manifest['segments'][i]
+    return seg['fname'], t - seg['start_ts']
+
+
+class _TimestampLogSplitter:
+    """
+    Copies the records of the timestamp log of a segmented recording to one
+    log per segment, next to the segment, with the same format, a segment
+    at a time, while the session log may still be written. Text logs are
+    copied line by line, so the '# N frames missing' lines are kept.
+    """
+
+    def __init__(self, tslog_fname):
+        self.binary = is_binary_timestamp_log(tslog_fname)
+        self.f = open(tslog_fname, 'rb')
+        if self.binary:
+            self.dtype, self.meta = _read_binary_header(self.f)
+        else:
+            self.meta, n_header = _read_text_header(
+                line.decode('utf-8') for line in self.f)
+            self.f.seek(0)
+            for i in range(n_header):
+                self.f.readline()
+        # Column of buf_ts in text logs, found from the first record
+        self._ts_col = None
+        # Data read but not copied yet, possibly ending in a partial record
+        self._rest = b''
+
+    def write_segment(self, seg, end_ts=None):
+        """
+        Writes the log of segment seg, a dict of the manifest, with the
+        records not copied yet whose buf_ts is before end_ts, all of them
+        if end_ts is None. Returns the log filename.
+        """
+        self._rest += self.f.read()
+        if self.binary:
+            n = len(self._rest) // self.dtype.itemsize
+            if not end_ts is None:
+                records = np.frombuffer(self._rest, dtype=self.dtype, count=n)
+                n = int(np.searchsorted(records['buf_ts'], end_ts))
+            cut = n * self.dtype.itemsize
+        else:
+            lines = self._rest.split(b'\n')[:-1]
+            n_copy = len(lines)
+            if not end_ts is None:
+                # Gap comments stay with the record following them
+                n_copy = 0
+                for i, line in enumerate(lines):
+                    if line.startswith(b'#'):
+                        continue
+                    fields = line.split(b',')
+                    if self._ts_col is None:
+                        # Webcam_h264 logs have an offset_ts column first
+                        self._ts_col = 2 if len(fields) == 4 else 1
+                    if float(fields[self._ts_col]) >= end_ts:
+                        break
+                    n_copy = i + 1
+            cut = sum(len(line) + 1 for line in lines[:n_copy])
+        data, self._rest = self._rest[:cut], self._rest[cut:]
+
+        fname = '%slog' % seg['fname'][:-3]
+        seg_meta = dict(self.meta, **{'video fname': seg['fname'],
+                                      'start_ts': seg['start_ts']})
+        if self.binary:
+            log = BinaryTimestampLog(fname, meta=seg_meta, dtype=self.dtype)
+            log.f.write(data)
+            log.close()
+        else:
+            header = ''.join('%s: %s\n' % (k, v) for k, v in seg_meta.items()
+                             if k != 'columns')
+            if 'columns' in self.meta:
+                header += '%s\n' % self.meta['columns']
+            with open(fname, 'wb') as f:
+                f.write(header.encode('utf-8'))
+                f.write(data)
+        return fname
+
+    def close(self):
+        self.f.close()
+
+
+def split_timestamp_log(tslog_fname, manifest):
+    """
+    Splits the timestamp log of a segmented recording into one log per
+    segment, next to the segment, with the same format. Records before the
+    first segment go to its log. Returns the list of log filenames.
+
+    Webcam writes these logs as the recording goes, this is to split a log
+    again, e.g. after a crash.
+
+    Parameters
+    ----------
+    tslog_fname -- session timestamp log
+    manifest    -- dict from load_segment_manifest, or its filename
+    """
+    if isinstance(manifest, str):
+        manifest = load_segment_manifest(manifest)
+    segments = manifest['segments']
+    splitter = _TimestampLogSplitter(tslog_fname)
+    fnames = []
+    try:
+        for i, seg in enumerate(segments):
+            end_ts = None
+            if i + 1 < len(segments):
+                end_ts = segments[i + 1]['start_ts']
+            fnames.append(splitter.write_segment(seg, end_ts))
+    finally:
+        splitter.close()
+    return fnames
+
+
+class AsyncTimestampLog:
+    """
+    Writes timestamp log records from a background thread, so that the
+    GStreamer streaming thread only puts a record tuple in a bounded queue
+    and never waits for the disk.
+
+    Records that do not fit in the queue are dropped and counted in
+    n_dropped, rather than stalling capture.
+    """
+
+    def __init__(self, log, max_queue=4096, fsync='never', batch_size=256,
+                 on_batch=None):
+        """
+        log        -- TextTimestampLog or BinaryTimestampLog
+        max_queue  -- maximum number of records waiting to be written (int)
+        fsync      -- when to fsync the log file: 'never' (default), 'batch'
+                      after every written batch, or a float, at most every
+                      fsync seconds
+        batch_size -- maximum number of records written per flush (int)
+        on_batch   -- optional function called from the writer thread with
+                      the last record of each batch, e.g. to update a
+                      textoverlay
+        """
+        self.log = log
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self.on_batch = on_batch
+        self.n_written = 0
+        self.n_dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._closed = False
+        self._t_fsync = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, *record):
+        if self._closed:
+            self.n_dropped += 1
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.n_dropped += 1
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            n_taken = len(batch)
+            # A write() racing with close() can queue a record after the
+            # sentinel, so look for it in the whole batch
+            if None in batch:
+                batch = batch[:batch.index(None)]
+                stop = True
+            try:
+                for record in batch:
+                    self.log.write(*record)
+                    self.n_written += 1
+                self.log.flush()
+                self._sync()
+                if batch and not self.on_batch is None:
+                    self.on_batch(batch[-1])
+            except Exception as err:
+                # Report and go on with the next batch, rather than leave
+                # flush() and close() waiting for a dead thread
+                print('Writing timestamp log %s failed: %s' %
+                      (self.log.fname, err))
+            finally:
+                for i in range(n_taken):
+                    self._queue.task_done()
+
+    def _sync(self):
+        if self.fsync == 'never':
+            return
+        t = time.perf_counter()
+        if self.fsync == 'batch' or t - self._t_fsync >= self.fsync:
+            os.fsync(self.log.f.fileno())
+            self._t_fsync = t
+
+    def flush(self):
+        """
+        Waits until all queued records are written.
+        """
+        if self._closed or not self._thread.is_alive():
+            return
+        self._queue.join()
+
+    def close(self):
+        self._closed = True
+        # Blocks until the writer thread has taken the queued records
+        while self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self._thread.join()
+        if self.fsync != 'never':
+            os.fsync(self.log.f.fileno())
+        self.log.close()
+        if self.n_dropped:
+            print('%d timestamp log records dropped' % self.n_dropped)
+
+
+def _make_element(spec, default, **props):
+    """
+    Makes a pipeline element from spec:
+        None        -- a default element, with properties props
+        str         -- a gst-launch description, e.g. 'fakesink sync=false',
+                       made into a bin with ghost pads for its unlinked pads
+        Gst.Element -- used as is
+    """
+    if spec is None:
+        element = Gst.ElementFactory.make(default, None)
+        for name, value in props.items():
+            element.set_property(name.replace('_', '-'), value)
+        return element
+    if isinstance(spec, str):
+        return Gst.parse_bin_from_description(spec, True)
+    return spec
+
+
+def test_source_description(srcenc='raw', fname=None, width=640, height=480,
+                            fps=15):
+    """
+    Returns a gst-launch description of a live video source that stands in
+    for a camera, to run Webcam without one, e.g.
+        Webcam(video_src=test_source_description('mjpeg'),
+               display_sink='fakesink sync=false', ...)
+
+    Parameters
+    ----------
+    srcenc -- format of the camera emulated, 'raw', 'mjpeg' or 'h264'
+    fname  -- video file to play, at its real time pace. Default: None,
+              videotestsrc
+    width  -- frame width (int)
+    height -- frame height (int)
+    fps    -- frame rate (int)
+    """
+    caps = 'video/x-raw,width=%d,height=%d,framerate=%d/1' % (width,
+                                                             height, fps)
+    if fname is None:
+        desc = 'videotestsrc is-live=true pattern=ball ! %s' % caps
+    else:
+        # identity sync=true releases buffers at their running time, as a
+        # live source would
+        desc = ('filesrc location="%s" ! decodebin ! videoconvert '
+                '! videoscale ! videorate ! %s ! identity sync=true' %
+                (fname, caps))
+    if 'peg' in srcenc:
+        desc += ' ! jpegenc'
+    elif '264' in srcenc:
+        desc += ' ! videoconvert ! x264enc tune=zerolatency ! h264parse'
+    else:
+        desc += ' ! videoconvert'
+    return desc
+
+
 class Webcam_h264:
     def __init__(self, video_dev='/dev/video0',
                  audio_dev=None,
                  fps=30,
-                 t_start=0.0):
+                 t_start=0.0,
+                 profile=False,
+                 video_src=None,
+                 display_sink=None,
+                 audio_src=None):
         """
+        profile: Whether to measure per element latency, see
+                 PipelineProfiler and self.profiler.
+        video_src, display_sink, audio_src: Replace the v4l2src, autovideosink
+                 and alsasrc, see Webcam.
+
         Understand audio_dev:
             hw:X,Y comes from this mapping of audio hardware
             X is the card number, while Y is the device number.
             Use 'arecord -l' to list the available cards and devices.
             http://jan.newmarch.name/LinuxSound/Sampled/Alsa/
         """
+        _init_gst()
 
-        if audio_dev is None:
+        if audio_dev is None and audio_src is None:
             audio = False
-        elif audio_dev is 'default':
-            audio_dev = "hw:2,0"
+        else:
+            if audio_dev == 'default':
+                audio_dev = "hw:2,0"
             audio = True
 
         ts_log_fname = 'webcam_h264_timestamps.log'
         vid_fname = 'webcam_h264.mkv'
-        self.ts_log = open(ts_log_fname, 'w')
-        self.ts_log.write('video filename: %s, t_start: %0.9f'
-                          '\nframe_number, offset_ts, pts, cam_running_ts\n' %
-                          (vid_fname, t_start))
+        self.ts_log = AsyncTimestampLog(
+            TextTimestampLog(ts_log_fname,
+                             'video filename: %s, t_start: %0.9f'
+                             '\nframe_number, offset_ts, pts, cam_running_ts\n' %
+                             (vid_fname, t_start),
+                             '%d,%0.9f,%0.9f,%0.9f\n'))
         if not t_start:
             self.t_start = datetime.now().timestamp()
         else:
@@ -161,26 +893,27 @@ class Webcam_h264:
             Function called from the pipeline by appsink.
             Writes the timestampes of frame capture to a log file.
             """
+            t0 = time.perf_counter()
             # Get the buffer
             smp = appsink.emit('pull-sample')
             buf = smp.get_buffer()
             timestamp = np.float64(1e-9) * buf.pts + self.offset_t
             timestamp1 = datetime.now().timestamp() - self.t_start
             self.n_frames += 1
-            self.ts_log.write('%d,%0.9f,%0.9f,%0.9f\n' %
-                              (self.n_frames,
-                               timestamp,
-                               buf.pts / Gst.SECOND,
-                               timestamp1))
+            self.ts_log.write(self.n_frames,
+                              timestamp,
+                              buf.pts / Gst.SECOND,
+                              timestamp1)
+            if not self.profiler is None:
+                self.profiler.record('on_new_sample', t0)
             return False
 
         ###########################
         # Create GStreamer elements
         ###########################
         # Video source:
-        self.v4l2src0 = Gst.ElementFactory.make('v4l2src', None)
-        self.v4l2src0.set_property('device', video_dev)
-        self.v4l2src0.set_property('do-timestamp', 'true')
+        self.v4l2src0 = _make_element(video_src, 'v4l2src',
+                                      device=video_dev, do_timestamp=True)
         # Video source filters:
         vid0caps = Gst.Caps.from_string('video/x-h264,width=%d,height=%d,'
                                         'framerate=%d/1' % (1280, 720, fps))
@@ -202,8 +935,8 @@ class Webcam_h264:
         disp0caps = Gst.Caps.from_string('video/x-raw,width=%d,height=%d' %
                                          (800, 600))
         # Sinks:
-        self.disp0sink = Gst.ElementFactory.make('autovideosink', None)
-        self.disp0sink.set_property('filter-caps', disp0caps)
+        self.disp0sink = _make_element(display_sink, 'autovideosink',
+                                       filter_caps=disp0caps)
         ####
         # File branch
         ####
@@ -236,11 +969,11 @@ class Webcam_h264:
 
         if audio:
             # Audio source:
-            self.alsasrc0 = Gst.ElementFactory.make('alsasrc')
-            self.alsasrc0.set_property('device', audio_dev)
+            self.alsasrc0 = _make_element(audio_src, 'alsasrc',
+                                          device=audio_dev)
             # Audio source filters:
             aud0caps = Gst.Caps.from_string('audio/x-raw,'
-                                            'format=S16LE'
+                                            'format=S16LE,'
                                             'rate=44100,'
                                             'channels=1')
             self.aud0filter = Gst.ElementFactory.make('capsfilter', None)
@@ -324,11 +1057,18 @@ class Webcam_h264:
         if not self.ts_queue.link(self.ts0sink):
             print('ts queue to ts-sink link failed')
 
+        # Per element latency and throughput
+        self.profiler = None
+        if profile:
+            self.profiler = PipelineProfiler(self.pipeline)
+
     def run(self):
         self.offset_t = datetime.now().timestamp() - self.t_start
         self.pipeline.set_state(Gst.State.PLAYING)
 
     def close(self):
+        if not self.profiler is None:
+            self.profiler.stop()
         self.pipeline.set_state(Gst.State.NULL)
         self.ts_log.close()
 
@@ -340,6 +1080,173 @@ class Webcam_h264:
         print('on_error():', msg.parse_error())
 
 
+class FrameRing:
+    """
+    A preallocated ring buffer of the last n frames, with their frame
+    numbers and capture pts, filled from a GStreamer streaming thread and
+    read from other threads. Frames are copied once, from the mapped buffer
+    into their slot, and nothing is allocated per frame.
+
+    Frames returned by latest() are views of a slot. They stay valid until
+    n further frames have been put.
+    """
+
+    def __init__(self, n, shape, dtype=np.uint8):
+        """
+        n     -- number of frames kept (int)
+        shape -- frame shape, (height, width) or (height, width, 3)
+        dtype -- frame dtype
+        """
+        self.frames = np.zeros((n,) + tuple(shape), dtype=dtype)
+        self.frame_n = np.full(n, -1, dtype=np.int64)
+        self.pts = np.full(n, np.nan)
+        self.n_put = 0
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return min(self.n_put, len(self.frames))
+
+    def put(self, frame, frame_n, pts):
+        """
+        Copies frame, e.g. a strided view of a mapped buffer, into the next
+        slot.
+        """
+        i = self.n_put % len(self.frames)
+        np.copyto(self.frames[i], frame)
+        self.frame_n[i] = frame_n
+        self.pts[i] = pts
+        with self._cond:
+            self.n_put += 1
+            self._cond.notify_all()
+
+    def latest(self, k=0):
+        """
+        Returns the k:th most recent (frame, frame_n, pts), or None if there
+        are not that many frames.
+        """
+        if k >= len(self):
+            return None
+        i = (self.n_put - 1 - k) % len(self.frames)
+        return self.frames[i], self.frame_n[i], self.pts[i]
+
+    def wait(self, n_seen, timeout=None):
+        """
+        Waits until more than n_seen frames have been put, or timeout
+        seconds. Returns the number of frames put.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self.n_put > n_seen, timeout)
+            return self.n_put
+
+    def notify(self):
+        """
+        Wakes up threads waiting in wait(), e.g. to stop them.
+        """
+        with self._cond:
+            self._cond.notify_all()
+
+
+# Encoder tuning profiles, properties set on theoraenc, vp8enc and x264enc:
+#   realtime -- lowest CPU per frame, few threads, for many cameras per rig
+#   balanced -- moderate CPU and quality
+#   archival -- best quality per byte, uses much more CPU
+# Values are strings, as in gst-launch, set with Gst.util_set_object_arg.
+ENCODER_PROFILES = {
+    'theoraenc': {'realtime': {'speed-level': '3',
+                               'quality': '32',
+                               'keyframe-max-distance': '60'},
+                  'balanced': {'speed-level': '2',
+                               'quality': '40',
+                               'keyframe-max-distance': '120'},
+                  'archival': {'speed-level': '0',
+                               'quality': '56',
+                               'keyframe-max-distance': '250'}},
+    'vp8enc': {'realtime': {'deadline': '1',
+                            'cpu-used': '16',
+                            'threads': '1',
+                            'lag-in-frames': '0',
+                            'keyframe-max-dist': '60'},
+               'balanced': {'deadline': '1',
+                            'cpu-used': '4',
+                            'threads': '2',
+                            'lag-in-frames': '0',
+                            'keyframe-max-dist': '120'},
+               'archival': {'deadline': '0',
+                            'cpu-used': '0',
+                            'threads': '4',
+                            'end-usage': 'cq',
+                            'cq-level': '10',
+                            'keyframe-max-dist': '250'}},
+    'x264enc': {'realtime': {'speed-preset': 'ultrafast',
+                             'tune': 'zerolatency',
+                             'threads': '1',
+                             'key-int-max': '60'},
+                'balanced': {'speed-preset': 'veryfast',
+                             'tune': 'zerolatency',
+                             'threads': '2',
+                             'key-int-max': '120'},
+                'archival': {'speed-preset': 'slow',
+                             'threads': '0',
+                             'pass': 'quant',
+                             'quantizer': '18',
+                             'key-int-max': '250'}}}
+
+
+def encoder_properties(encoder, profile=None, props=None):
+    """
+    Returns the properties to set on an encoder, a dict of strings.
+
+    Parameters
+    ----------
+    encoder -- 'theoraenc', 'vp8enc' or 'x264enc'
+    profile -- 'realtime', 'balanced' or 'archival', see ENCODER_PROFILES.
+               Default: None, the encoder defaults, except for a realtime
+               deadline on vp8enc and tune=zerolatency on x264enc
+    props   -- dict of properties overriding those of the profile, e.g.
+               {'threads': 4, 'bitrate': 2000}
+    """
+    if profile is None:
+        out = {'theoraenc': {},
+               'vp8enc': {'deadline': '1'},
+               'x264enc': {'tune': 'zerolatency'}}[encoder]
+    else:
+        out = dict(ENCODER_PROFILES[encoder][profile])
+    if not props is None:
+        out.update({name: str(value) for name, value in props.items()})
+    return out
+
+
+def _set_properties(element, props):
+    """
+    Sets element properties from a dict of gst-launch style values, e.g.
+    {'leaky': 'downstream', 'max-size-buffers': 1}.
+    """
+    for name, value in props.items():
+        Gst.util_set_object_arg(element, name, str(value))
+
+
+# Default queue properties of the Webcam tee branches. The file and
+# timestamp branches never drop buffers, they block the tee when full. The
+# display branch keeps only the newest frame, so that a slow display does
+# not hold up recording.
+_BRANCH_QUEUES = {'file': {'max-size-buffers': 0,
+                           'max-size-bytes': 0,
+                           'max-size-time': 3 * 10**9,
+                           'leaky': 'no'},
+                  'timestamp': {'max-size-buffers': 200,
+                                'max-size-bytes': 0,
+                                'max-size-time': 0,
+                                'leaky': 'no'},
+                  'display': {'max-size-buffers': 1,
+                              'max-size-bytes': 0,
+                              'max-size-time': 0,
+                              'leaky': 'downstream'},
+                  'live': {'max-size-buffers': 1,
+                           'max-size-bytes': 0,
+                           'max-size-time': 0,
+                           'leaky': 'downstream'}}
+
+
 class Webcam:
     """
     Test commands:
@@ -411,7 +1318,25 @@ class Webcam:
                  srcenc='mjpeg',
                  writeenc='theora',
                  draw_timestamp=True,
-                 verbose=True):
+                 verbose=True,
+                 profile=False,
+                 tslog_format='text',
+                 tslog_fsync='never',
+                 tslog_queue=4096,
+                 video_src=None,
+                 display_sink=None,
+                 audio_src=None,
+                 width=640,
+                 height=480,
+                 queues=None,
+                 live_frames=0,
+                 frame_callback=None,
+                 live_format='RGB',
+                 segment_duration=None,
+                 segment_size=None,
+                 enc_profile=None,
+                 enc_props=None,
+                 timestamp_track=False):
         """
         Parameters
         ----------
@@ -431,8 +1356,74 @@ class Webcam:
         writeenc       : Encoding of saved video.
                          Alternatives: 'theora'(default), 'vp8' and 'mp4'.
                          Theora probably produces the most reliavle timestamps.
+                         'passthrough' writes the camera stream as is, e.g.
+                         the JPEG frames with srcenc='mjpeg', without
+                         decoding and encoding. Only the display and live
+                         branches then decode, and draw_timestamp is off.
         dra_timestamp  : Whether to draw timestamp on saved video.
                          Default: True
+        profile        : Whether to measure per element latency and
+                         throughput, see PipelineProfiler. The profiler is
+                         self.profiler. Default: False
+        tslog_format   : Format of the timestamp log, 'text' (default) or
+                         'binary', see BinaryTimestampLog and
+                         load_timestamp_log. None writes no log, e.g. with
+                         timestamp_track.
+        tslog_fsync    : When to fsync the timestamp log, 'never' (default),
+                         'batch' or at most every tslog_fsync seconds (float),
+                         see AsyncTimestampLog.
+        tslog_queue    : Maximum number of timestamp records waiting to be
+                         written. Records arriving when it is full are
+                         dropped and counted in self.ts_log.n_dropped.
+                         Default: 4096
+        video_src      : Replaces the v4l2src on video_dev. A Gst.Element or
+                         a gst-launch description, e.g. from
+                         test_source_description, to run without a camera.
+                         It must give the format given by srcenc.
+                         Default: None, v4l2src
+        display_sink   : Replaces the xvimagesink of the display branch, e.g.
+                         'fakesink sync=false' to run without a display.
+                         Default: None, xvimagesink
+        audio_src      : Replaces the alsasrc on audio_dev, e.g.
+                         'audiotestsrc is-live=true'. Setting it enables
+                         audio. Default: None
+        width, height  : Frame size from the camera. Default: 640x480
+        queues         : Queue properties of the tee branches, 'file',
+                         'timestamp' and 'display', e.g.
+                         {'display': {'max-size-buffers': 5}}. Given
+                         properties override those in _BRANCH_QUEUES. By
+                         default display drops the oldest frame when its
+                         queue is full, and file and timestamp never drop.
+                         See branch_stats for buffer counts per branch.
+        live_frames    : Number of frames kept in self.frame_ring, a
+                         FrameRing filled by a live-frame branch, to process
+                         frames while recording. Default: 0, no live branch
+        frame_callback : Function called as frame_callback(frame, frame_n,
+                         pts) from a consumer thread with the latest frame.
+                         Frames arriving while it runs are skipped and
+                         counted in self.live_skipped. frame is a view of a
+                         self.frame_ring slot, see FrameRing. Default: None
+        live_format    : 'RGB' (default) or 'GRAY8', format of live frames
+        segment_duration : Split the recording into segments of about this
+                         many seconds, video_fname[:-4] + '_00000.mkv' etc,
+                         starting at keyframes. Default: None
+        segment_size   : Split the recording into segments of about this
+                         many bytes. Default: None
+                         With segments, a manifest mapping capture time to
+                         segment is written to video_fname[:-4] +
+                         '_segments.json', see segment_for_time, and the
+                         timestamp log of each segment is written next to
+                         it once the segment is finished.
+        enc_profile    : Encoder tuning, 'realtime', 'balanced' or
+                         'archival', see ENCODER_PROFILES. Default: None
+        enc_props      : Encoder properties overriding those of enc_profile,
+                         e.g. {'threads': 2, 'bitrate': 1500}.
+        timestamp_track: Whether to store the frame number, buffer pts and
+                         Python time of each frame as a text subtitle track
+                         in the video file, see read_timestamp_track and
+                         VideoReader.get_current_timestamp. Unlike
+                         draw_timestamp it leaves the frames untouched, and
+                         needs no decoding. Default: False
 
         Returns/output
         --------------
@@ -444,6 +1435,7 @@ class Webcam:
             Use 'arecord -l' to list the available cards and devices.
 
         """
+        _init_gst()
         if not video_fname is None:
             self.write = True
             if not video_fname.endswith('.mkv'):
@@ -455,22 +1447,31 @@ class Webcam:
                 tslog_fname = '%slog' % video_fname[:-3]
         else:
             self.write = False
-
+        self.video_fname = video_fname
+        self.tslog_fname = tslog_fname
+
+        self.segmented = self.write and bool(segment_duration or segment_size)
+        self.segments = []
+        self._segment_msgs = queue.Queue()
+        self._segment_thread = None
+        self._splitter = None
         self.timestamp = timestamp
         self.display = display
         if not self.timestamp:
             draw_timestamp = False
         self.draw_timestamp = draw_timestamp
 
-        if audio_dev is None:
+        if audio_dev is None and audio_src is None:
             self.audio = False
-        elif audio_dev is 'default':
-            audio_dev = "hw:2,0"
+        else:
+            if audio_dev == 'default':
+                audio_dev = "hw:2,0"
             self.audio = True
 
         writeparse = None
-        writeenc_prop = None
-        if 'theora' in writeenc:
+        if 'pass' in writeenc:
+            writeenc = 'passthrough'
+        elif 'theora' in writeenc:
             writeenc = 'theoraenc'
             writeenc_caps = 'video/x-theora'
             writeparse = 'theoraparse'
@@ -481,7 +1482,6 @@ class Webcam:
             writeenc = 'x264enc'
             writeenc_caps = 'video/x-h264'
             writeparse = 'h264parse'
-            writeenc_prop = ('tune', 'zerolatency')
 
         srcparse = None
         srcdec = None
@@ -489,23 +1489,36 @@ class Webcam:
             src_caps = ('video/x-raw,'
                         'format=YUY2,'
                         'width=%d,height=%d,'
-                        'framerate=%d/1' % (640, 480, fps))
+                        'framerate=%d/1' % (width, height, fps))
         elif 'peg' in srcenc:
             src_caps = ('image/jpeg,'
                         'width=%d,height=%d,'
-                        'framerate=%d/1' % (640, 480, fps))
+                        'framerate=%d/1' % (width, height, fps))
             srcdec = 'jpegdec'
         elif '264' in srcenc:
             src_caps = ('video/x-h264,'
                         'width=%d,height=%d,'
-                        'framerate=%d/1' % (640, 480, fps))
+                        'framerate=%d/1' % (width, height, fps))
             srcparse = 'h264parse'
             srcdec = 'avdec_h264'
 
+        # When the camera stream is written as is, the decoder is only used
+        # in the branches that need pixels, display and live.
         skip_encdec = False
-        if ('264' in srcenc) and (writeenc is 'x264enc'):
+        branch_dec = None
+        if ('264' in srcenc) and (writeenc == 'x264enc'):
             skip_encdec = True
+        elif writeenc == 'passthrough':
+            skip_encdec = True
+            writeenc_caps = src_caps.split(',')[0]
+        if skip_encdec:
+            branch_dec = srcdec
             srcdec = None
+            if self.draw_timestamp:
+                # textoverlay needs raw frames
+                if verbose:
+                    print('draw_timestamp is turned off, it needs re-encoding')
+                self.draw_timestamp = False
 
         if type(t_start) is float:
             self.t_start = datetime.utcfromtimestamp(t_start)
@@ -514,13 +1527,51 @@ class Webcam:
         else:
             self.t_start = datetime.now()
 
-        if self.timestamp:
-            self.ts_log = open(tslog_fname, 'w')
-            self.ts_log.write('video fname: %s\nstart_time: %s\nframe_number, '
-                              'offset_ts, cam_running_ts, python_ts\n' %
-                              (video_fname, self.t_start.strftime('%Y-%m-%d %H:%M:%S.%f')))
+        self.timestamp_track = timestamp_track and self.write and \
+            self.timestamp
+        self.ts_log = None
+        if self.timestamp and not tslog_format is None:
+            start_time = self.t_start.strftime('%Y-%m-%d %H:%M:%S.%f')
+            if tslog_format == 'binary':
+                log = BinaryTimestampLog(tslog_fname,
+                                         meta={'video fname': video_fname,
+                                               'start_time': start_time})
+            else:
+                log = TextTimestampLog(tslog_fname,
+                                       'video fname: %s\nstart_time: %s\nframe_number, '
+                                       'offset_ts, cam_running_ts, python_ts\n' %
+                                       (video_fname, start_time),
+                                       flag_gaps=True)
+            # The textoverlay is updated from the writer thread, once per
+            # written batch, rather than on the streaming thread.
+            on_batch = None
+            if self.draw_timestamp:
+                on_batch = self._draw_timestamp
+            self.ts_log = AsyncTimestampLog(log, max_queue=tslog_queue,
+                                            fsync=tslog_fsync,
+                                            on_batch=on_batch)
 
         self.n_frames = 0
+        # Capture pts gaps
+        self.n_missing = 0
+        self._last_pts = None
+        self._dt_ns = Gst.SECOND // fps
+        # Buffers leaving a branch queue more than two frame durations after
+        # capture are counted as late
+        self._late_ns = 2 * self._dt_ns
+        self._branches = OrderedDict()
+        if queues is None:
+            queues = {}
+        if not frame_callback is None and not live_frames:
+            live_frames = 4
+        self.live = bool(live_frames)
+        self.frame_callback = frame_callback
+        self.frame_ring = None
+        self.live_skipped = 0
+        self._n_live = 0
+        self._live_strides = None
+        self._consumer = None
+        self._stop_consumer = False
 
         # Create GStreamer pipline
         self.pipeline = Gst.Pipeline()
@@ -536,9 +1587,8 @@ class Webcam:
         # Create GStreamer elements
         ###########################
         # Video source:
-        self.v4l2src0 = Gst.ElementFactory.make('v4l2src', None)
-        self.v4l2src0.set_property('device', video_dev)
-        self.v4l2src0.set_property('do-timestamp', 'true')
+        self.v4l2src0 = _make_element(video_src, 'v4l2src',
+                                      device=video_dev, do_timestamp=True)
         # Video source filters
         # Formats available from C920 camera:
         #   'image/jpeg', 'video/x-h264', 'video/x-raw'
@@ -560,16 +1610,21 @@ class Webcam:
             if not skip_encdec:
                 self.vid_conv = Gst.ElementFactory.make('videoconvert')
                 self.vid_enc = Gst.ElementFactory.make(writeenc, None)
-                if not writeenc_prop is None:
-                    self.vid_enc.set_property(writeenc_prop[0],
-                                              writeenc_prop[1])
+                _set_properties(self.vid_enc,
+                                encoder_properties(writeenc, enc_profile,
+                                                   enc_props))
                 if not writeparse is None:
                     self.vid_parse = Gst.ElementFactory.make(writeparse, None)
-            self.mux = Gst.ElementFactory.make('matroskamux', None)
+            if self.segmented:
+                self.mux = self._make_splitmuxsink(video_fname,
+                                                   segment_duration,
+                                                   segment_size)
+            else:
+                self.mux = Gst.ElementFactory.make('matroskamux', None)
             mux_caps = Gst.Caps.from_string('%s,'
                                             'width=%d,height=%d,'
                                             'framerate=%d/1' %
-                                            (writeenc_caps, 640, 480, fps))
+                                            (writeenc_caps, width, height, fps))
             self.file_sink = Gst.ElementFactory.make('filesink', None)
             self.file_sink.set_property('location', video_fname)
             self.file_sink.set_property('sync', False)
@@ -598,33 +1653,33 @@ class Webcam:
         ####
         if self.display:
             self.disp_queue = Gst.ElementFactory.make('queue', None)
-            if skip_encdec:
-                self.disp_dec = Gst.ElementFactory.make('avdec_h264', None)
+            if not branch_dec is None:
+                self.disp_dec = Gst.ElementFactory.make(branch_dec, None)
             # Scale to display size:
             self.disp_scale = Gst.ElementFactory.make('videoscale', None)
             # Display filter caps:
             disp_caps = Gst.Caps.from_string('video/x-raw,'
                                              'width=%d,height=%d' %
-                                             (640, 480))
+                                             (width, height))
             # display sink:
-            self.disp_sink = Gst.ElementFactory.make('xvimagesink', None)
-            self.disp_sink.set_property('sync', False)
+            self.disp_sink = _make_element(display_sink, 'xvimagesink',
+                                           sync=False)
             #self.disp0sink.set_property('filter-caps', disp0caps)
 
         if self.audio:
             # Audio source:
-            self.alsasrc0 = Gst.ElementFactory.make('alsasrc')
-            self.alsasrc0.set_property('device', audio_dev)
+            self.alsasrc0 = _make_element(audio_src, 'alsasrc',
+                                          device=audio_dev)
             # Audio source filters:
             aud_caps = Gst.Caps.from_string('audio/x-raw,'
-                                            'format=S16LE'
+                                            'format=S16LE,'
                                             'rate=44100,'
                                             'channels=1')
             self.aud_filter = Gst.ElementFactory.make('capsfilter', None)
             self.aud_filter.set_property('caps', aud_caps)
             # Encode audio:
-            self.audconv = Gst.ElementFactory.make('audioconvert', None)
-            self.audenc = Gst.ElementFactory.make('flacenc', None)
+            self.aud_conv = Gst.ElementFactory.make('audioconvert', None)
+            self.aud_enc = Gst.ElementFactory.make('flacenc', None)
             self.aud_queue = Gst.ElementFactory.make('queue', None)
 
         # Add elements to the pipeline
@@ -644,7 +1699,8 @@ class Webcam:
                 if not writeparse is None:
                     self.pipeline.add(self.vid_parse)
             self.pipeline.add(self.mux)
-            self.pipeline.add(self.file_sink)
+            if not self.segmented:
+                self.pipeline.add(self.file_sink)
         if self.timestamp:
             if self.draw_timestamp:
                 self.pipeline.add(self.textoverlay)
@@ -653,7 +1709,7 @@ class Webcam:
 
         if self.display:
             self.pipeline.add(self.disp_scale)
-            if skip_encdec:
+            if not branch_dec is None:
                 self.pipeline.add(self.disp_dec)
             self.pipeline.add(self.disp_sink)
             self.pipeline.add(self.disp_queue)
@@ -733,7 +1789,7 @@ class Webcam:
                 else:
                     if not self.file_queue.link_filtered(self.mux, mux_caps):
                         print('file queue to filter & mux link failed')
-            if not self.mux.link(self.file_sink):
+            if not self.segmented and not self.mux.link(self.file_sink):
                 print('mux to file-sink link failed')
 
         if self.timestamp:
@@ -747,7 +1803,7 @@ class Webcam:
             # video display sink
             if not self.tee0.link(self.disp_queue):
                 print('tee to display queue link failed')
-            if skip_encdec:
+            if not branch_dec is None:
                 if not self.disp_queue.link(self.disp_dec):
                     print('display queue to display decode link failed')
                 if not self.disp_dec.link(self.disp_scale):
@@ -771,6 +1827,214 @@ class Webcam:
             if not self.aud_queue.link(self.mux):
                 print('audio queue to mux link failed')
 
+        ####
+        # Live-frame branch
+        ####
+        if self.live:
+            if live_format == 'GRAY8':
+                shape = (height, width)
+            else:
+                shape = (height, width, 3)
+            self.frame_ring = FrameRing(live_frames, shape)
+            self.live_queue = Gst.ElementFactory.make('queue', None)
+            self.live_conv = Gst.ElementFactory.make('videoconvert', None)
+            live_caps = Gst.Caps.from_string('video/x-raw,format=%s,'
+                                             'width=%d,height=%d' %
+                                             (live_format, width, height))
+            self.live_sink = Gst.ElementFactory.make('appsink', None)
+            self.live_sink.set_property('emit-signals', True)
+            self.live_sink.set_property('sync', False)
+            self.live_sink.set_property('max-buffers', 1)
+            self.live_sink.set_property('drop', True)
+            self.live_sink.connect('new-sample', self.on_live_sample)
+            self.pipeline.add(self.live_queue)
+            self.pipeline.add(self.live_conv)
+            self.pipeline.add(self.live_sink)
+            if not self.tee0.link(self.live_queue):
+                print('tee to live queue link failed')
+            if not branch_dec is None:
+                self.live_dec = Gst.ElementFactory.make(branch_dec, None)
+                self.pipeline.add(self.live_dec)
+                if not self.live_queue.link(self.live_dec):
+                    print('live queue to live decode link failed')
+                if not self.live_dec.link(self.live_conv):
+                    print('live decode to live convert link failed')
+            elif not self.live_queue.link(self.live_conv):
+                print('live queue to live convert link failed')
+            if not self.live_conv.link_filtered(self.live_sink, live_caps):
+                print('live convert to live-sink link failed')
+
+        ####
+        # Timestamp subtitle track
+        ####
+        if self.timestamp_track:
+            self.ts_src = Gst.ElementFactory.make('appsrc', None)
+            self.ts_src.set_property('caps', Gst.Caps.from_string(
+                'text/x-raw,format=utf8'))
+            self.ts_src.set_property('format', Gst.Format.TIME)
+            self.ts_src.set_property('is-live', True)
+            self.pipeline.add(self.ts_src)
+            # Request the subtitle pad explicitly, rather than letting
+            # link() pick a pad from the caps. request_pad_simple is
+            # GStreamer >= 1.20.
+            if hasattr(self.mux, 'request_pad_simple'):
+                ts_pad = self.mux.request_pad_simple('subtitle_%u')
+            else:
+                ts_pad = self.mux.get_request_pad('subtitle_%u')
+            if ts_pad is None:
+                print('mux has no subtitle pad')
+            elif self.ts_src.get_static_pad('src').link(ts_pad) != \
+                    Gst.PadLinkReturn.OK:
+                print('timestamp source to mux link failed')
+
+        # Branch queue limits, leak policy and buffer counters
+        if self.write:
+            self._setup_branch('file', self.file_queue, queues)
+        if self.timestamp:
+            self._setup_branch('timestamp', self.ts_queue, queues)
+        if self.display:
+            self._setup_branch('display', self.disp_queue, queues)
+        if self.live:
+            self._setup_branch('live', self.live_queue, queues)
+
+        # Per element latency and throughput
+        self.profiler = None
+        if profile:
+            self.profiler = PipelineProfiler(self.pipeline)
+
+    def _make_splitmuxsink(self, video_fname, duration, size):
+        """
+        Makes a splitmuxsink writing matroska segments of video_fname, and
+        connects the messages it posts when segments open and close.
+        """
+        mux = Gst.ElementFactory.make('splitmuxsink', None)
+        mux.set_property('muxer', Gst.ElementFactory.make('matroskamux', None))
+        mux.set_property('location', '%s_%%05d.mkv' % video_fname[:-4])
+        if duration:
+            mux.set_property('max-size-time', int(duration * Gst.SECOND))
+            if not size:
+                # Ask the encoder for a keyframe at the split time, instead
+                # of waiting for the next one
+                mux.set_property('send-keyframe-requests', True)
+        if size:
+            mux.set_property('max-size-bytes', int(size))
+        # Sync messages are delivered without a GLib main loop, which the
+        # async bus watch would need
+        self.bus.connect('sync-message::element', self._on_segment_message)
+        return mux
+
+    def _on_segment_message(self, bus, msg):
+        """
+        Passes the segment opened and closed messages of splitmuxsink to
+        the segment thread, see _handle_segments. Runs on the streaming
+        thread, so it does not touch the disk.
+        """
+        st = msg.get_structure()
+        if st is None:
+            return
+        name = st.get_name()
+        if name in ('splitmuxsink-fragment-opened',
+                    'splitmuxsink-fragment-closed'):
+            self._segment_msgs.put((name, st.get_string('location'),
+                                    1e-9 * st.get_value('running-time')))
+
+    def _handle_segments(self):
+        """
+        Keeps self.segments up to date and rewrites the manifest when a
+        segment is closed, and writes the timestamp log of a segment when
+        the next one is opened, so that both are valid even after a crash.
+        Runs on its own thread, from run() until close().
+        """
+        while True:
+            item = self._segment_msgs.get()
+            if item is None:
+                break
+            name, location, running_ts = item
+            try:
+                if name == 'splitmuxsink-fragment-opened':
+                    if self.segments:
+                        self._write_segment_log(self.segments[-1],
+                                                running_ts)
+                    self.segments.append({'fname': location,
+                                          'start_ts': running_ts,
+                                          'end_ts': None})
+                elif self.segments:
+                    self.segments[-1]['end_ts'] = running_ts
+                    self._write_manifest()
+            except Exception as err:
+                print('Segment %s: %s' % (location, err))
+
+    def _write_segment_log(self, seg, end_ts=None):
+        """
+        Copies the timestamp log records of segment seg, those before
+        end_ts, to its own log, see _TimestampLogSplitter.
+        """
+        if self.ts_log is None:
+            return
+        self.ts_log.flush()
+        if self._splitter is None:
+            self._splitter = _TimestampLogSplitter(self.tslog_fname)
+        self._splitter.write_segment(seg, end_ts)
+
+    def _write_manifest(self):
+        fname = _segment_manifest_fname(self.video_fname)
+        tmp = '%s.tmp' % fname
+        with open(tmp, 'w') as f:
+            json.dump({'video fname': self.video_fname,
+                       'segments': self.segments}, f, indent=1)
+        os.replace(tmp, fname)
+
+    def _setup_branch(self, branch, branch_queue, queues):
+        """
+        Sets the queue properties of a tee branch and adds probes counting
+        the buffers entering and leaving the queue.
+        """
+        props = dict(_BRANCH_QUEUES[branch])
+        props.update(queues.get(branch, {}))
+        _set_properties(branch_queue, props)
+        st = {'in': 0, 'out': 0, 'late': 0}
+        self._branches[branch] = (branch_queue, st)
+        branch_queue.get_static_pad('sink').add_probe(
+            Gst.PadProbeType.BUFFER, self._on_branch_in, st)
+        branch_queue.get_static_pad('src').add_probe(
+            Gst.PadProbeType.BUFFER, self._on_branch_out, st)
+
+    def _on_branch_in(self, pad, info, st):
+        st['in'] += 1
+        return Gst.PadProbeReturn.OK
+
+    def _on_branch_out(self, pad, info, st):
+        st['out'] += 1
+        clock = self.pipeline.get_clock()
+        pts = info.get_buffer().pts
+        if not clock is None and pts != Gst.CLOCK_TIME_NONE:
+            now = clock.get_time() - self.pipeline.get_base_time()
+            if now - pts > self._late_ns:
+                st['late'] += 1
+        return Gst.PadProbeReturn.OK
+
+    def branch_stats(self):
+        """
+        Buffer counts of the tee branches, a dict with a dict per branch:
+            in      -- buffers that entered the branch queue
+            out     -- buffers that left it
+            queued  -- buffers in the queue now
+            dropped -- buffers dropped by a leaky queue
+            late    -- buffers that left the queue more than two frame
+                       durations after capture
+        The frames missing from the camera, gaps in pts, are in
+        self.n_missing and in the timestamp log.
+        """
+        stats = OrderedDict()
+        for branch, (branch_queue, st) in self._branches.items():
+            queued = branch_queue.get_property('current-level-buffers')
+            stats[branch] = {'in': st['in'],
+                             'out': st['out'],
+                             'queued': queued,
+                             'dropped': max(0, st['in'] - st['out'] - queued),
+                             'late': st['late']}
+        return stats
+
     ###########################
     # Callback function for writing timestamps
     ###########################
@@ -779,24 +2043,88 @@ class Webcam:
         Function called from the pipeline by appsink.
         Writes the timestampes of frame capture to a log file.
         """
+        t0 = time.perf_counter()
         # Get the buffer
         smp = appsink.emit('pull-sample')
         buf = smp.get_buffer()
-        py_ts = time.perf_counter() - self.t0 + self.ts_offset
+        py_ts = t0 - self.t0 + self.ts_offset
         buf_ts = np.float64(1e-9) * buf.pts
         self.n_frames += 1
-        self.ts_log.write('%d,%0.9f,%0.9f\n' %
-                          (self.n_frames,
-                           buf_ts,
-                           py_ts))
-        if self.draw_timestamp:
-            parsed_ts = ('frame #: %d, buf_ts: %0.5f, py_ts: %0.5f\n' %
-                         (self.n_frames,
-                          buf_ts,
-                          py_ts))
-            self.textoverlay.set_property('text', parsed_ts)
+        n_missing = 0
+        if not self._last_pts is None:
+            n_missing = max(0, int(round((buf.pts - self._last_pts) /
+                                         self._dt_ns)) - 1)
+            self.n_missing += n_missing
+        self._last_pts = buf.pts
+        if not self.ts_log is None:
+            self.ts_log.write(self.n_frames, buf_ts, py_ts, n_missing)
+        if self.timestamp_track:
+            text = '%d,%0.9f,%0.9f' % (self.n_frames, buf_ts, py_ts)
+            ts_buf = Gst.Buffer.new_wrapped(text.encode('utf-8'))
+            ts_buf.pts = buf.pts
+            ts_buf.duration = self._dt_ns
+            self.ts_src.emit('push-buffer', ts_buf)
+        if not self.profiler is None:
+            self.profiler.record('on_new_sample', t0)
+        return Gst.FlowReturn.OK
+
+    def on_live_sample(self, appsink):
+        """
+        Function called from the pipeline by the live-frame appsink.
+        Copies the frame into self.frame_ring.
+        """
+        smp = appsink.emit('pull-sample')
+        buf = smp.get_buffer()
+        if self._live_strides is None:
+            # Row stride from the caps, it includes any row padding
+            vinfo = _video_info_from_caps(smp.get_caps())
+            self._live_strides = (vinfo.stride[0],) + \
+                self.frame_ring.frames.strides[2:]
+        # Strides and offset of the buffer itself if it carries a video meta
+        meta = GstVideo.buffer_get_video_meta(buf)
+        if meta is None:
+            strides, offset = self._live_strides, 0
+        else:
+            strides = (meta.stride[0],) + self._live_strides[1:]
+            offset = meta.offset[0]
+        mapinfo = _map_buffer(buf)
+        if mapinfo is None:
+            print('Failed to map buffer.')
+            return Gst.FlowReturn.OK
+        view = np.ndarray(shape=self.frame_ring.frames.shape[1:],
+                          dtype=np.uint8,
+                          buffer=mapinfo.data,
+                          offset=offset,
+                          strides=strides)
+        self._n_live += 1
+        self.frame_ring.put(view, self._n_live, np.float64(1e-9) * buf.pts)
+        del view
+        buf.unmap(mapinfo)
         return Gst.FlowReturn.OK
 
+    def _consume_frames(self):
+        """
+        Calls frame_callback with the latest frame of self.frame_ring, until
+        close().
+        """
+        n_seen = 0
+        while not self._stop_consumer:
+            n_put = self.frame_ring.wait(n_seen, timeout=0.5)
+            if n_put == n_seen:
+                continue
+            self.live_skipped += n_put - n_seen - 1
+            n_seen = n_put
+            frame, frame_n, pts = self.frame_ring.latest()
+            self.frame_callback(frame, frame_n, pts)
+
+    def _draw_timestamp(self, record):
+        """
+        Sets the textoverlay text to the last logged timestamp record.
+        """
+        parsed_ts = ('frame #: %d, buf_ts: %0.5f, py_ts: %0.5f\n' %
+                     record[:3])
+        self.textoverlay.set_property('text', parsed_ts)
+
     ######################################################
     # Generates the dot file, checks that graphviz in installed
     # and generates a png file, which then displays the pipeline
@@ -819,6 +2147,14 @@ class Webcam:
     def run(self):
         self.ts_offset = datetime.now().timestamp() - self.t_start.timestamp()
         self.t0 = time.perf_counter()
+        if not self.frame_callback is None:
+            self._consumer = threading.Thread(target=self._consume_frames,
+                                              daemon=True)
+            self._consumer.start()
+        if self.segmented:
+            self._segment_thread = threading.Thread(
+                target=self._handle_segments, daemon=True)
+            self._segment_thread.start()
         self.pipeline.set_state(Gst.State.PLAYING)
 
     def close(self):
@@ -832,47 +2168,231 @@ class Webcam:
         bus = self.pipeline.get_bus()
         self.shutdown_msg = bus.timed_pop_filtered(Gst.CLOCK_TIME_NONE,
                                                    Gst.MessageType.EOS | Gst.MessageType.ERROR)
+        if not self.profiler is None:
+            self.profiler.stop()
         # free resources
         self.pipeline.set_state(Gst.State.NULL)
-        if self.timestamp:
+        if not self._consumer is None:
+            self._stop_consumer = True
+            self.frame_ring.notify()
+            self._consumer.join()
+        if not self._segment_thread is None:
+            # The last segment is closed by the EOS
+            self._segment_msgs.put(None)
+            self._segment_thread.join()
+        if not self.ts_log is None:
             self.ts_log.close()
+        if self.segmented and self.segments:
+            self._write_manifest()
+            self._write_segment_log(self.segments[-1])
+        if not self._splitter is None:
+            self._splitter.close()
 
     def on_sync_message(self, bus, msg):
-        if msg.get_structure().get_name() == 'prepare-window-handle':
+        st = msg.get_structure()
+        if not st is None and st.get_name() == 'prepare-window-handle':
             msg.src.set_property('force-aspect-ratio', True)
 
     def on_error(self, bus, msg):
         print('on_error():', msg.parse_error())
 
 
-class Webcam_ts_minimal_h264:
-    def __init__(self, video_dev='/dev/video0', fps=15):
+# Timestamp log records of MultiWebcam: camera index, frame number of that
+# camera, buffer pts on the shared pipeline clock (s) and Python clock (s).
+_multi_tslog_dtype = np.dtype([('cam', '<i4'),
+                               ('frame_n', '<i8'),
+                               ('buf_ts', '<f8'),
+                               ('py_ts', '<f8')])
+
+
+class MultiWebcam:
+    """
+    Records several cameras in one pipeline, so that all share the
+    pipeline clock and base time, and start together when the pipeline goes
+    to PLAYING. Buffer timestamps of different cameras are thus directly
+    comparable.
+
+    The timestamps of all cameras go to one binary timestamp log (see
+    load_timestamp_log), with the camera index in the 'cam' field. They are
+    collected by a single thread that polls the appsinks of all cameras,
+    rather than by one Python callback per camera and frame.
+
+    Example, headless with test sources:
+        cams = MultiWebcam(['videotestsrc', 'videotestsrc'],
+                           ['cam0.mkv', 'cam1.mkv'], 'cams.log')
+        cams.run()
+        time.sleep(10)
+        cams.close()
+    """
+
+    def __init__(self, video_devs, video_fnames, tslog_fname, fps=15,
+                 srcenc='mjpeg', writeenc='theora', width=640, height=480,
+                 t_start=None, enc_profile=None, enc_props=None):
         """
+        Parameters
+        ----------
+        video_devs   -- list of video devices, e.g. '/dev/video0', or
+                        'videotestsrc' for a live test source
+        video_fnames -- list of video file names, one per device
+        tslog_fname  -- file name of the merged timestamp log
+        fps          -- frame rate (int)
+        srcenc       -- 'raw' or 'mjpeg', format from the cameras
+        writeenc     -- 'theora' (default), 'vp8', 'x264' or 'passthrough',
+                        to write the camera stream without re-encoding
+        width        -- frame width (int)
+        height       -- frame height (int)
+        t_start      -- float or datetime, by default (None) set to current
+                        computer time
+        enc_profile  -- encoder tuning, see Webcam
+        enc_props    -- encoder properties, see Webcam
         """
-        ts_log_fname = 'ts_test.log'
+        _init_gst()
+        if len(video_devs) != len(video_fnames):
+            raise ValueError('video_devs and video_fnames differ in length')
 
-        self.ts_log = open(ts_log_fname, 'w')
-        self.ts_log.write('n_buf, buf.pts\n')
-        self.n_frames = 0
-        self.pipeline = Gst.Pipeline()
+        if 'raw' in srcenc:
+            src_caps = 'video/x-raw,format=YUY2'
+            test_enc = ''
+            src_dec = ''
+        else:
+            src_caps = 'image/jpeg'
+            test_enc = ' ! jpegenc'
+            src_dec = ' ! jpegdec'
+        src_caps = ('%s,width=%d,height=%d,framerate=%d/1' %
+                    (src_caps, width, height, fps))
+
+        if 'pass' in writeenc:
+            writeenc, parse = None, ''
+            src_dec = ''
+        elif 'theora' in writeenc:
+            writeenc, parse = 'theoraenc', ' ! theoraparse'
+        elif 'vp8' in writeenc:
+            writeenc, parse = 'vp8enc', ''
+        elif '264' in writeenc:
+            writeenc, parse = 'x264enc', ' ! h264parse'
+        else:
+            raise ValueError('Unknown writeenc: %s' % writeenc)
+        if writeenc is None:
+            enc = ''
+        else:
+            props = encoder_properties(writeenc, enc_profile, enc_props)
+            enc = ' '.join(['videoconvert !', writeenc] +
+                           ['%s=%s' % item for item in props.items()])
+            enc = '%s%s ! ' % (enc, parse)
+
+        branches = []
+        for i, (dev, fname) in enumerate(zip(video_devs, video_fnames)):
+            if dev.startswith('videotestsrc'):
+                src = 'videotestsrc is-live=true pattern=ball%s' % test_enc
+            else:
+                src = 'v4l2src device=%s do-timestamp=true' % dev
+            branches.append(
+                '%s ! %s%s ! tee name=tee%d '
+                'tee%d. ! queue ! %smatroskamux '
+                '! filesink location="%s" sync=false '
+                'tee%d. ! queue ! appsink name=ts_sink%d emit-signals=false '
+                'sync=false drop=false' %
+                (src, src_caps, src_dec, i, i, enc, fname, i, i))
+        self.pipeline = Gst.parse_launch(' '.join(branches))
+        self.ts_sinks = [self.pipeline.get_by_name('ts_sink%d' % i)
+                         for i in range(len(video_devs))]
+        self.bus = self.pipeline.get_bus()
+        self.bus.add_signal_watch()
+        self.bus.connect('message::error', self.on_error)
 
-        def on_new_sample(appsink):
-            """
-            Function called from the pipeline by appsink.
+        if type(t_start) is float:
+            self.t_start = datetime.utcfromtimestamp(t_start)
+        elif type(t_start) is datetime:
+            self.t_start = t_start
+        else:
+            self.t_start = datetime.now()
+
+        self.video_fnames = list(video_fnames)
+        self.ts_log = BinaryTimestampLog(
+            tslog_fname, dtype=_multi_tslog_dtype,
+            meta={'video fnames': self.video_fnames,
+                  'video devs': list(video_devs),
+                  'start_time': self.t_start.strftime('%Y-%m-%d %H:%M:%S.%f')})
+        self.n_frames = [0] * len(video_devs)
+        # Poll at 4 times the frame rate
+        self.poll_interval = 0.25 / fps
+        self._stop = threading.Event()
+        self._collector = None
+
+    def _collect(self):
+        """
+        Pulls the samples of all appsinks and logs their timestamps, until
+        close() sets self._stop and all appsinks are drained.
+        """
+        while True:
+            stopping = self._stop.is_set()
+            n = 0
+            for i, sink in enumerate(self.ts_sinks):
+                smp = sink.emit('try-pull-sample', 0)
+                while not smp is None:
+                    py_ts = time.perf_counter() - self.t0 + self.ts_offset
+                    self.n_frames[i] += 1
+                    self.ts_log.write(i, self.n_frames[i],
+                                      np.float64(1e-9) * smp.get_buffer().pts,
+                                      py_ts)
+                    n += 1
+                    smp = sink.emit('try-pull-sample', 0)
+            if stopping and not n:
+                break
+            if not n:
+                time.sleep(self.poll_interval)
+
+    def run(self):
+        self.ts_offset = datetime.now().timestamp() - self.t_start.timestamp()
+        self.t0 = time.perf_counter()
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+        # One state change for all cameras: a common base time
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def close(self):
+        # EOS, so that the video files are finalized
+        self.pipeline.send_event(Gst.Event.new_eos())
+        self.shutdown_msg = self.bus.timed_pop_filtered(
+            Gst.CLOCK_TIME_NONE, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+        self._stop.set()
+        if not self._collector is None:
+            self._collector.join()
+        self.pipeline.set_state(Gst.State.NULL)
+        self.ts_log.close()
+
+    def on_error(self, bus, msg):
+        print('on_error():', msg.parse_error())
+
+
+class Webcam_ts_minimal_h264:
+    def __init__(self, video_dev='/dev/video0', fps=15, video_src=None):
+        """
+        video_src: Replaces the v4l2src on video_dev, see Webcam.
+        """
+        _init_gst()
+        ts_log_fname = 'ts_test.log'
+
+        self.ts_log = AsyncTimestampLog(
+            TextTimestampLog(ts_log_fname, 'n_buf, buf.pts\n', '%d,%0.9f\n'))
+        self.n_frames = 0
+        self.pipeline = Gst.Pipeline()
+
+        def on_new_sample(appsink):
+            """
+            Function called from the pipeline by appsink.
             Writes the timestampes of frame capture to a log file.
             """
             # Get the buffer
             smp = appsink.emit('pull-sample')
             buf = smp.get_buffer()
             self.n_frames += 1
-            self.ts_log.write('%d,%0.9f\n' %
-                              (self.n_frames, np.float64(1e-9) * buf.pts))
+            self.ts_log.write(self.n_frames, np.float64(1e-9) * buf.pts)
             return Gst.FlowReturn.OK
 
         # Video source:
-        self.v4l2src = Gst.ElementFactory.make('v4l2src', None)
-        self.v4l2src.set_property('device', video_dev)
-        self.v4l2src.set_property('do-timestamp', 'true')
+        self.v4l2src = _make_element(video_src, 'v4l2src',
+                                     device=video_dev, do_timestamp=True)
         # Formats available from C920 camera:
         #   'image/jpeg', 'video/x-h264', 'video/x-raw'
         vid_caps = Gst.Caps.from_string('video/x-h264,'
@@ -909,13 +2429,16 @@ class Webcam_ts_minimal_h264:
 
 
 class Webcam_ts_minimal_raw:
-    def __init__(self, video_dev='/dev/video0', fps=15):
+    def __init__(self, video_dev='/dev/video0', fps=15, video_src=None):
         """
+        video_src: Replaces the v4l2src on video_dev, see Webcam.
         """
+        _init_gst()
         ts_log_fname = 'ts_test.log'
 
-        self.ts_log = open(ts_log_fname, 'w')
-        self.ts_log.write('n_buf, buf.pts, time.perf_counter()\n')
+        self.ts_log = AsyncTimestampLog(
+            TextTimestampLog(ts_log_fname,
+                             'n_buf, buf.pts, time.perf_counter()\n'))
         self.n_frames = 0
         self.t0 = 0.0
         self.pipeline = Gst.Pipeline()
@@ -931,13 +2454,12 @@ class Webcam_ts_minimal_raw:
             pts = np.float64(1e-9) * buf.pts
             t = time.perf_counter() - self.t0
             self.n_frames += 1
-            self.ts_log.write('%d,%0.9f,%0.9f\n' % (self.n_frames, pts, t))
+            self.ts_log.write(self.n_frames, pts, t)
             return Gst.FlowReturn.OK
 
         # Video source:
-        self.v4l2src = Gst.ElementFactory.make('v4l2src', None)
-        self.v4l2src.set_property('device', video_dev)
-        self.v4l2src.set_property('do-timestamp', 'true')
+        self.v4l2src = _make_element(video_src, 'v4l2src',
+                                     device=video_dev, do_timestamp=True)
         # Formats available from C920 camera:
         #   'image/jpeg', 'video/x-h264', 'video/x-raw'
         vid_caps = Gst.Caps.from_string('video/x-raw,'
@@ -976,53 +2498,696 @@ class Webcam_ts_minimal_raw:
         self.ts_log.close()
 
 
-def get_frames_in_interval(vid_fn, ts_fn, interval=[0, -1]):
+def _iterate(it):
+    """
+    Returns a list with the items of a Gst.Iterator.
     """
+    items = []
+    while True:
+        ret, item = it.next()
+        if ret == Gst.IteratorResult.OK:
+            items.append(item)
+        elif ret == Gst.IteratorResult.RESYNC:
+            it.resync()
+            items = []
+        else:
+            break
+    return items
+
+
+class PipelineProfiler:
+    """
+    Per element latency and throughput of a pipeline, measured with buffer
+    probes on the pads of every element.
+
+    The latency of an element is the time from a buffer entering it, on a
+    sink pad, until a buffer with the same pts leaves it, on a src pad. It
+    is kept in a histogram with bins of powers of 2 microseconds. Sources
+    and sinks only get buffer counts and rates. The time spent in Python
+    callbacks, e.g. appsink new-sample handlers, can be added with record().
+
+    Example:
+        prof = PipelineProfiler(pipeline)
+        prof.start_dumping('profile.jsonl', interval=10.0)
+        ...
+        print(prof.stats())
+        prof.stop()
+
+    The probes run on the streaming threads, so profiling costs a little on
+    every buffer of every element. Only use it when looking for the cause
+    of late or dropped frames.
+    """
+
+    # Histogram bin i holds latencies in [2**(i-1), 2**i) us, the last bin
+    # also everything longer, i.e. from 1 us to about 16 s.
+    n_bins = 25
+
+    def __init__(self, pipeline):
+        """
+        pipeline -- the Gst.Pipeline to profile
+        """
+        self.pipeline = pipeline
+        self._stats = OrderedDict()
+        self._probes = []
+        self._dump_thread = None
+        self._stop_dumping = threading.Event()
+        self.t_start = time.perf_counter_ns()
+        self.add_elements()
+
+    def add_elements(self):
+        """
+        Adds probes to the elements not profiled yet, e.g. those created by
+        decodebin after the profiler.
+        """
+        for element in _iterate(self.pipeline.iterate_recurse()):
+            if isinstance(element, Gst.Bin):
+                continue  # Its children are profiled
+            name = element.get_name()
+            if name in self._stats:
+                continue
+            st = self._new_stat()
+            self._stats[name] = st
+            for pad in _iterate(element.iterate_sink_pads()):
+                probe = pad.add_probe(Gst.PadProbeType.BUFFER,
+                                      self._on_sink_buffer, st)
+                self._probes.append((pad, probe))
+            for pad in _iterate(element.iterate_src_pads()):
+                probe = pad.add_probe(Gst.PadProbeType.BUFFER,
+                                      self._on_src_buffer, st)
+                self._probes.append((pad, probe))
+
+    def _new_stat(self):
+        return {'hist': np.zeros(self.n_bins, dtype=np.int64),
+                'n_in': 0,
+                'n_out': 0,
+                'n_lat': 0,
+                'sum_us': 0.0,
+                'max_us': 0.0,
+                't_first': None,
+                't_last': None,
+                'pending': {}}
+
+    def _add_latency(self, st, us):
+        st['hist'][min(int(us).bit_length(), self.n_bins - 1)] += 1
+        st['n_lat'] += 1
+        st['sum_us'] += us
+        if us > st['max_us']:
+            st['max_us'] = us
+
+    def _on_sink_buffer(self, pad, info, st):
+        t = time.perf_counter_ns()
+        st['n_in'] += 1
+        if st['n_out'] == 0:
+            # Sinks only have sink pads, count their rate here
+            if st['t_first'] is None:
+                st['t_first'] = t
+            st['t_last'] = t
+        pending = st['pending']
+        if len(pending) > 1000:
+            pending.clear()  # pts not kept by this element, e.g. a muxer
+        pending[info.get_buffer().pts] = t
+        return Gst.PadProbeReturn.OK
+
+    def _on_src_buffer(self, pad, info, st):
+        t = time.perf_counter_ns()
+        if st['n_out'] == 0:
+            st['t_first'] = t
+        st['n_out'] += 1
+        st['t_last'] = t
+        t_in = st['pending'].pop(info.get_buffer().pts, None)
+        if not t_in is None:
+            self._add_latency(st, (t - t_in) * 1e-3)
+        return Gst.PadProbeReturn.OK
+
+    def record(self, name, t0):
+        """
+        Records the time from t0 (time.perf_counter()) until now as a
+        latency of name, e.g. of a Python callback.
+        """
+        t = time.perf_counter_ns()
+        st = self._stats.get(name)
+        if st is None:
+            st = self._stats.setdefault(name, self._new_stat())
+        if st['t_first'] is None:
+            st['t_first'] = t
+        st['t_last'] = t
+        st['n_out'] += 1
+        self._add_latency(st, (time.perf_counter() - t0) * 1e6)
+
+    def stats(self):
+        """
+        Returns a dict with, per element: number of buffers in and out,
+        buffer rate (per second), mean, approximate median and 99th
+        percentile, and max latency in us, and the latency histogram.
+        """
+        out = OrderedDict()
+        for name, st in list(self._stats.items()):
+            hist = st['hist'].copy()
+            n = max(st['n_out'], st['n_in'])
+            rate = 0.0
+            if n > 1 and st['t_last'] > st['t_first']:
+                rate = (n - 1) / ((st['t_last'] - st['t_first']) * 1e-9)
+            res = {'n_in': st['n_in'],
+                   'n_out': st['n_out'],
+                   'rate': rate}
+            if st['n_lat']:
+                cum = np.cumsum(hist) / hist.sum()
+                # Upper edge of the bin containing the percentile
+                res['mean_us'] = st['sum_us'] / st['n_lat']
+                res['p50_us'] = float(2**np.searchsorted(cum, 0.5))
+                res['p99_us'] = float(2**np.searchsorted(cum, 0.99))
+                res['max_us'] = st['max_us']
+                res['hist'] = hist.tolist()
+            out[name] = res
+        return out
+
+    def dump(self, fname):
+        """
+        Appends the current stats as one JSON line to fname.
+        """
+        rec = {'t': (time.perf_counter_ns() - self.t_start) * 1e-9,
+               'stats': self.stats()}
+        with open(fname, 'a') as f:
+            f.write(json.dumps(rec) + '\n')
+
+    def start_dumping(self, fname, interval=10.0):
+        """
+        Dumps the stats to fname every interval seconds, from a background
+        thread, until stop().
+        """
+        def dump_loop():
+            while not self._stop_dumping.wait(interval):
+                self.dump(fname)
+
+        self._stop_dumping.clear()
+        self._dump_thread = threading.Thread(target=dump_loop, daemon=True)
+        self._dump_thread.start()
+
+    def stop(self):
+        """
+        Stops dumping and removes the probes. The stats are kept.
+        """
+        self._stop_dumping.set()
+        if not self._dump_thread is None:
+            self._dump_thread.join()
+            self._dump_thread = None
+        for pad, probe in self._probes:
+            pad.remove_probe(probe)
+        self._probes = []
+
+
+class FrameCache:
+    """
+    Least recently used cache of decoded frames, keyed by pts (ns).
+
+    Frames are evicted, least recently used first, when the total size of
+    the cached frames exceeds max_bytes. Cached frames are read-only.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        max_bytes -- memory budget of the cache in bytes (int)
+        """
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._frames = OrderedDict()
+        self._keys = []  # pts of cached frames, sorted
+
+    def __len__(self):
+        return len(self._frames)
+
+    def get(self, pts, tol=0):
+        """
+        Returns (pts, frame) of a cached frame with pts within +/- tol ns of
+        pts, or None if there is no such frame.
+        """
+        i = bisect.bisect_left(self._keys, pts - tol)
+        if i < len(self._keys) and self._keys[i] <= pts + tol:
+            key = self._keys[i]
+            self._frames.move_to_end(key)
+            self.hits += 1
+            return key, self._frames[key]
+        self.misses += 1
+        return None
+
+    def put(self, pts, frame):
+        """
+        Adds a frame to the cache. The cache keeps a reference to frame,
+        which is made read-only.
+        """
+        if frame.nbytes > self.max_bytes:
+            return
+        if pts in self._frames:
+            self._frames.move_to_end(pts)
+            return
+        frame.flags.writeable = False
+        self._frames[pts] = frame
+        bisect.insort(self._keys, pts)
+        self.n_bytes += frame.nbytes
+        while self.n_bytes > self.max_bytes:
+            key, old = self._frames.popitem(last=False)
+            del self._keys[bisect.bisect_left(self._keys, key)]
+            self.n_bytes -= old.nbytes
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Removes all frames from the cache. Keeps the counters.
+        """
+        self._frames.clear()
+        self._keys = []
+        self.n_bytes = 0
+
+    def stats(self):
+        """
+        Returns a dict with the hit, miss and eviction counters and the
+        current size of the cache.
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'n_frames': len(self._frames),
+                'n_bytes': self.n_bytes,
+                'max_bytes': self.max_bytes}
+
+
+# Fields of the frame index, one row per frame, sorted on pts.
+# offset is -1 when the demuxer/parser does not provide byte offsets.
+_frame_index_dtype = [('pts', np.int64),
+                      ('keyframe', bool),
+                      ('offset', np.int64)]
+
+# Gst.CLOCK_TIME_NONE and GST_BUFFER_OFFSET_NONE
+_GST_NONE = 2**64 - 1
+
+
+def _frame_index_fname(fname):
+    """
+    Filename of the frame index sidecar file saved next to the video.
+    """
+    return '%s.idx.npz' % fname
+
+
+def build_frame_index(fname):
+    """
+    Builds the frame index of a video file, i.e. the pts, keyframe flag and
+    byte offset of every frame.
+
+    The file is demuxed and parsed but not decoded, so this is considerably
+    faster than reading through the file.
+
     Parameters
     ----------
-    video_fn     -- filename of video
-    tslog_fn     -- filename of timestamp log
-    interval     -- list or tuple with t0 and t1, the first and last time
-                    in the interval to extract.
+    fname   -- video filename (str)
+
     Returns
     -------
-    frames       -- The read frames
-    n_and_tes    -- frame numbers and timestamps for the frames
+    index   -- numpy structured array with fields pts (ns), keyframe and
+               offset (bytes), sorted on pts. None if scanning failed.
     """
+    _init_gst()
+    if not os.path.isfile(fname):
+        raise ValueError('No such file: %s' % fname)
+
+    pipeline = Gst.Pipeline()
+    src = Gst.ElementFactory.make('filesrc', None)
+    src.set_property('location', fname)
+    parse = Gst.ElementFactory.make('parsebin', None)
+    sink = Gst.ElementFactory.make('appsink', None)
+    sink.set_property('sync', False)
+    sink.set_property('max-buffers', 200)
+    pipeline.add(src)
+    pipeline.add(parse)
+    pipeline.add(sink)
+    if not src.link(parse):
+        print('file source to parsebin link failed')
+        return None
+
+    sinkpad = sink.get_static_pad('sink')
+
+    def on_pad_added(element, pad):
+        # Only the (first) video stream is indexed
+        caps = pad.get_current_caps()
+        if caps is None:
+            caps = pad.query_caps(None)
+        name = caps.get_structure(0).get_name()
+        if name.startswith('video/') and not sinkpad.is_linked():
+            pad.link(sinkpad)
+
+    parse.connect('pad-added', on_pad_added)
+
+    pts, keyframe, offset = [], [], []
+    bus = pipeline.get_bus()
+    pipeline.set_state(Gst.State.PLAYING)
+    while True:
+        smp = sink.emit('try-pull-sample', Gst.SECOND)
+        if smp is None:
+            if sink.get_property('eos'):
+                break
+            msg = bus.pop_filtered(Gst.MessageType.ERROR)
+            if not msg is None:
+                print('Indexing %s failed:' % fname, msg.parse_error())
+                pipeline.set_state(Gst.State.NULL)
+                return None
+            continue
+        buf = smp.get_buffer()
+        if buf.has_flags(Gst.BufferFlags.HEADER):
+            # Stream headers, e.g. the theora header packets, are not frames
+            continue
+        t = buf.pts
+        if t == _GST_NONE:
+            t = buf.dts
+        if t == _GST_NONE:
+            continue
+        pts.append(t)
+        keyframe.append(not buf.has_flags(Gst.BufferFlags.DELTA_UNIT))
+        offset.append(-1 if buf.offset == _GST_NONE else buf.offset)
+    pipeline.set_state(Gst.State.NULL)
+
+    # Buffers come in decoding order, frames are numbered in display order.
+    index = np.empty(len(pts), dtype=_frame_index_dtype)
+    index['pts'] = pts
+    index['keyframe'] = keyframe
+    index['offset'] = offset
+    index.sort(order='pts', kind='stable')
+
+    return index
+
+
+def save_frame_index(fname, index):
+    """
+    Saves the frame index next to the video file, together with the size and
+    modification time of the video so that a stale index is detected.
+    """
+    st = os.stat(fname)
+    with open(_frame_index_fname(fname), 'wb') as f:
+        np.savez(f, index=index, size=st.st_size, mtime=st.st_mtime)
 
-    dtypes = [('frame_n', int),
-              ('ts', np.float64),
-              ('run_ts', np.float64),
-              ('py_ts', np.float64),
-              ('vid_ts', np.float64)]
 
-    n_and_ts = np.genfromtxt(ts_fn, dtype=dtypes, skip_header=2, delimiter=',')
+def load_frame_index(fname):
+    """
+    Loads the frame index saved next to the video file.
 
-    reader = VideoReader(vid_fn)
+    Returns None if there is no index or if the video has changed since the
+    index was saved.
+    """
+    idx_fname = _frame_index_fname(fname)
+    if not os.path.isfile(idx_fname):
+        return None
+
+    st = os.stat(fname)
+    with np.load(idx_fname) as data:
+        if (int(data['size']) != st.st_size or
+            float(data['mtime']) != st.st_mtime):
+            return None
+        return data['index']
+
+
+def get_frame_index(fname):
+    """
+    Returns the frame index of a video file. Loads it from the sidecar file
+    if there is an up to date one, otherwise builds and saves it.
+    """
+    index = load_frame_index(fname)
+    if index is None:
+        index = build_frame_index(fname)
+        if not index is None:
+            try:
+                save_frame_index(fname, index)
+            except OSError as err:
+                print('Could not save frame index: %s' % err)
+    return index
+
+
+# Records of the timestamp track of a video written with Webcam
+# timestamp_track: pts of the frame in the file (ns), and the frame number,
+# buffer pts (s) and Python time (s) logged when it was captured.
+_timestamp_track_dtype = np.dtype([('pts', '<i8'),
+                                   ('frame_n', '<i8'),
+                                   ('buf_ts', '<f8'),
+                                   ('py_ts', '<f8')])
+
+
+def read_timestamp_track(fname):
+    """
+    Reads the timestamp subtitle track of a video recorded with Webcam
+    timestamp_track=True. Only the subtitle stream is demuxed, the video is
+    not decoded.
+
+    Returns
+    -------
+    records -- numpy structured array with fields pts (ns, in the file),
+               frame_n, buf_ts and py_ts, sorted on pts. None if the file
+               has no timestamp track or reading failed.
+    """
+    _init_gst()
+    if not os.path.isfile(fname):
+        raise ValueError('No such file: %s' % fname)
+
+    pipeline = Gst.Pipeline()
+    src = Gst.ElementFactory.make('filesrc', None)
+    src.set_property('location', fname)
+    parse = Gst.ElementFactory.make('parsebin', None)
+    sink = Gst.ElementFactory.make('appsink', None)
+    sink.set_property('sync', False)
+    sink.set_property('max-buffers', 200)
+    pipeline.add(src)
+    pipeline.add(parse)
+    pipeline.add(sink)
+    if not src.link(parse):
+        print('file source to parsebin link failed')
+        return None
+
+    sinkpad = sink.get_static_pad('sink')
+
+    def on_pad_added(element, pad):
+        caps = pad.get_current_caps()
+        if caps is None:
+            caps = pad.query_caps(None)
+        name = caps.get_structure(0).get_name()
+        if name == 'text/x-raw' and not sinkpad.is_linked():
+            pad.link(sinkpad)
+
+    parse.connect('pad-added', on_pad_added)
+
+    rows = []
+    bus = pipeline.get_bus()
+    pipeline.set_state(Gst.State.PLAYING)
+    while True:
+        smp = sink.emit('try-pull-sample', Gst.SECOND)
+        if smp is None:
+            if sink.get_property('eos'):
+                break
+            msg = bus.pop_filtered(Gst.MessageType.ERROR |
+                                   Gst.MessageType.EOS)
+            if not msg is None:
+                if msg.type == Gst.MessageType.ERROR:
+                    print('Reading %s failed:' % fname, msg.parse_error())
+                break
+            continue
+        buf = smp.get_buffer()
+        mapinfo = _map_buffer(buf)
+        if mapinfo is None:
+            continue
+        fields = bytes(mapinfo.data).decode('utf-8').rstrip('\x00').split(',')
+        buf.unmap(mapinfo)
+        try:
+            rows.append((buf.pts, int(fields[0]), float(fields[1]),
+                         float(fields[2])))
+        except (ValueError, IndexError):
+            continue
+    pipeline.set_state(Gst.State.NULL)
+
+    if not rows:
+        return None
+    records = np.array(rows, dtype=_timestamp_track_dtype)
+    records.sort(order='pts', kind='stable')
+    return records
+
+
+# Fields of the timestamp log records used by get_frames_in_interval.
+# vid_ts is the time of the frame in the video, filled in when read.
+_interval_log_dtype = [('frame_n', int),
+                       ('ts', np.float64),
+                       ('run_ts', np.float64),
+                       ('py_ts', np.float64),
+                       ('vid_ts', np.float64)]
+
+
+def _read_ts_log_interval(ts_fn, t0, t1):
+    """
+    Reads the records of a timestamp log with t0 <= ts <= t1.
 
-    t0, t1 = interval, interval[1]
+    The log is read line by line and only the records in the interval are
+    kept, so memory use depends on the length of the interval, not the log.
+    Header lines are skipped.
+
+    Logs with frame number, buffer pts and Python time (Webcam) use the
+    Python time as ts and the pts as run_ts.
+    """
+    if is_binary_timestamp_log(ts_fn):
+        records = load_timestamp_log(ts_fn)[0]
+        if 'offset_ts' in records.dtype.names:
+            ts = records['offset_ts']
+        else:
+            ts = records['py_ts']
+        ix = np.nonzero((ts >= t0) & (ts <= t1))[0]
+        n_and_ts = np.zeros(len(ix), dtype=_interval_log_dtype)
+        n_and_ts['frame_n'] = records['frame_n'][ix]
+        n_and_ts['ts'] = ts[ix]
+        n_and_ts['run_ts'] = records['buf_ts'][ix]
+        n_and_ts['py_ts'] = records['py_ts'][ix]
+        n_and_ts['vid_ts'] = np.nan
+        return n_and_ts
+
+    rows = []
+    with open(ts_fn, 'r') as f:
+        for line in f:
+            fields = line.split(',')
+            try:
+                row = [int(fields[0])] + [float(x) for x in fields[1:4]]
+            except (ValueError, IndexError):
+                continue  # header
+            if len(row) == 3:
+                row = [row[0], row[2], row[1], row[2]]
+            if len(row) < 4:
+                continue
+            if row[1] < t0:
+                continue
+            if row[1] > t1:
+                break  # The log is in time order
+            rows.append(tuple(row) + (np.nan,))
+
+    return np.array(rows, dtype=_interval_log_dtype)
+
+
+def iter_frames_in_interval(vid_fn, ts_fn, interval=[0, -1]):
+    """
+    Iterates over the frames in an interval together with their timestamp
+    log records, without keeping more than one frame in memory.
+
+    Parameters
+    ----------
+    video_fn     -- filename of video
+    tslog_fn     -- filename of timestamp log
+    interval     -- list or tuple with t0 and t1, the first and last time
+                    in the interval to extract. t1 = -1 means until the end.
+    Yields
+    ------
+    n_and_ts     -- frame number and timestamps of the frame (record)
+    frame        -- the frame
+    """
+    n_and_ts = _interval_records(ts_fn, interval)
+    if not len(n_and_ts):
+        return
+
+    reader = VideoReader(vid_fn)
+    frames = reader.iter_frames(n_and_ts[0]['run_ts'])
+    try:
+        for rec, (t, frame) in zip(n_and_ts, frames):
+            rec['vid_ts'] = t
+            yield rec, frame
+    finally:
+        # Finish the frame generator, which returns the pipeline to PAUSED,
+        # before the pipeline is closed
+        frames.close()
+        reader.close()
+
+
+def _interval_records(ts_fn, interval):
+    """
+    Timestamp log records in interval, see get_frames_in_interval.
+    """
+    t0, t1 = interval[0], interval[1]
     if t1 == -1:  # Until end
-        t1 = reader.duration_seconds
+        t1 = np.inf
+    n_and_ts = _read_ts_log_interval(ts_fn, t0, t1)
+    if not len(n_and_ts):
+        print('No frames in the interval %s.' % str(interval))
+    return n_and_ts
 
-    n_and_ts = n_and_ts[n_and_ts['ts'] >= t0]
-    n_and_ts = n_and_ts[n_and_ts['ts'] <= t1]
 
-    frames = []
-    frames.append(reader.get_frame(n_and_ts[0]['run_ts']))
-    t = reader.get_current_position('time')
+def save_frames_in_interval(vid_fn, ts_fn, out_fn, interval=[0, -1]):
+    """
+    Writes the frames in an interval to a .npy file, one frame at a time
+    through a memory map, so that intervals larger than the memory can be
+    extracted. The timestamp records are saved next to it, in
+    out_fn[:-4] + '_ts.npy'.
+
+    Parameters
+    ----------
+    video_fn     -- filename of video
+    tslog_fn     -- filename of timestamp log
+    out_fn       -- filename of the frames (.npy)
+    interval     -- list or tuple with t0 and t1, the first and last time
+                    in the interval to extract. t1 = -1 means until the end.
+    Returns
+    -------
+    frames       -- The frames, memory mapped from out_fn
+    n_and_tes    -- frame numbers and timestamps for the frames
+    """
+    if not out_fn.endswith('.npy'):
+        out_fn = '%s.npy' % out_fn
+    n_and_ts = _interval_records(ts_fn, interval)
+    if not len(n_and_ts):
+        return None, n_and_ts
 
+    reader = VideoReader(vid_fn)
+    frames = np.lib.format.open_memmap(out_fn, mode='w+', dtype=np.uint8,
+                                       shape=(len(n_and_ts),) +
+                                       tuple(reader.frame_shape))
     i = 0
-    while t <= n_and_ts[-1]['run_ts']:
-        frames.append(reader.get_next_frame())
-        t = reader.get_current_position('time')
+    vid_frames = reader.iter_frames(n_and_ts[0]['run_ts'], copy=False)
+    for t, frame in vid_frames:
+        frames[i] = frame
         n_and_ts['vid_ts'][i] = t
         i += 1
-
+        if i == len(n_and_ts):
+            break
+    frame = None
+    vid_frames.close()
     reader.close()
+    if i < len(n_and_ts):
+        print('Video ended after %d of %d frames.' % (i, len(n_and_ts)))
+
+    frames.flush()
+    np.save('%s_ts.npy' % out_fn[:-4], n_and_ts)
 
     return frames, n_and_ts
 
 
+def get_frames_in_interval(vid_fn, ts_fn, interval=[0, -1]):
+    """
+    Parameters
+    ----------
+    video_fn     -- filename of video
+    tslog_fn     -- filename of timestamp log
+    interval     -- list or tuple with t0 and t1, the first and last time
+                    in the interval to extract.
+    Returns
+    -------
+    frames       -- The read frames
+    n_and_tes    -- frame numbers and timestamps for the frames
+
+    All frames are kept in memory, for long intervals use
+    iter_frames_in_interval or save_frames_in_interval instead.
+    """
+    frames = []
+    n_and_ts = []
+    it = iter_frames_in_interval(vid_fn, ts_fn, interval)
+    try:
+        for rec, frame in it:
+            frames.append(frame)
+            n_and_ts.append(rec)
+    finally:
+        it.close()
+
+    return frames, np.array(n_and_ts, dtype=_interval_log_dtype)
+
+
 class VideoReader:
     """
     For reading video frames one-by-one.
@@ -1036,11 +3201,32 @@ class VideoReader:
     By Hjalmar K. Turesson 2015-12-08
     """
 
-    def __init__(self, fname, color=True):
+    def __init__(self, fname, color=True, index=False, cache_bytes=0,
+                 size=None, crop=None, fps=None, profile=False):
         """
         fname -- video filename (str)
         color -- Whether to return frames in color or gray scale (bool)
+        index -- Whether to use a frame index for frame accurate positioning
+                 (bool). The index is built on first use and saved next to
+                 the video file (fname + '.idx.npz'), after which it is
+                 loaded instead of rebuilt.
+        cache_bytes -- Memory budget, in bytes, of a cache of decoded frames
+                       (int). Default 0, no cache. See FrameCache.
+        size  -- (width, height) of the returned frames. Default None, the
+                 size of the video (or of the crop).
+        crop  -- (x, y, width, height) rectangle, in pixels of the video, to
+                 crop out of the frames. Default None, no cropping.
+        fps   -- frame rate of the returned frames, lower than that of the
+                 video to skip frames (float). Default None, all frames.
+                 The frame index is not used together with fps.
+        profile -- Whether to measure per element latency and throughput
+                   (bool), see PipelineProfiler and self.profiler.
+
+        Cropping, scaling and frame rate decimation are done in the pipeline,
+        before the color conversion, so that only the requested pixels are
+        converted and copied.
         """
+        _init_gst()
 
         if color:
             fmt = 'RGB'
@@ -1051,29 +3237,103 @@ class VideoReader:
         if not os.path.isfile(fname):
             raise ValueError('No such file: %s' % fname)
 
-        s = ('filesrc location=%s '
-             '! decodebin '
-             '! videoconvert '
-             '! video/x-raw, format=%s '
-             '! appsink name=sink' % (fname, fmt))
+        # Crop, then drop frames, then scale, all before videoconvert.
+        filters = []
+        caps = 'video/x-raw, format=%s' % fmt
+        if not crop is None:
+            filters.append('videocrop name=crop')
+        if not fps is None:
+            fps = Fraction(fps).limit_denominator(1001)
+            filters.append('videorate name=rate')
+            caps += ', framerate=%d/%d' % (fps.numerator, fps.denominator)
+        if not size is None:
+            filters.append('videoscale name=scale')
+            caps += ', width=%d, height=%d' % tuple(size)
+        filters.append('videoconvert name=conv')
+
+        # decodebin is linked to the first filter in on_pad_added() and not
+        # by parse_launch, so that the link is redone when a new file is
+        # opened in the same pipeline, see reopen().
+        s = ('filesrc name=src '
+             '! decodebin name=dec '
+             '%s '
+             '! %s '
+             '! appsink name=sink' % (' ! '.join(filters), caps))
         self.pipeline = Gst.parse_launch(s)
+        self.filesrc = self.pipeline.get_by_name('src')
+        self._filter0 = self.pipeline.get_by_name(filters[0].split('=')[-1])
+        self.pipeline.get_by_name('dec').connect('pad-added',
+                                                 self._on_pad_added)
 
         # get sink
         self.appsink = self.pipeline.get_by_name("sink")
         self.appsink.set_property("max-buffers", 20)  # To limit memory usage
-        # set to PAUSED to make the first frame arrive in the sink
+        # Do not sync to the clock, iter_frames() runs as fast as it can decode
+        self.appsink.set_property("sync", False)
+
+        self._crop = crop
+        self._rate = fps
+        self._use_index = index
+
+        # Buffer and map info backing the last frame returned with copy=False
+        self._mapped = None
+
+        # Cache of decoded frames
+        self.cache = None
+        if cache_bytes:
+            self.cache = FrameCache(cache_bytes)
+
+        self.is_open = self._open(fname)
+
+        # Per element latency and throughput. After the preroll, so that
+        # the elements created by decodebin are included.
+        self.profiler = None
+        if profile:
+            self.profiler = PipelineProfiler(self.pipeline)
+
+    def _on_pad_added(self, decodebin, pad):
+        """
+        Links the video pad of decodebin to the first filter.
+        """
+        caps = pad.get_current_caps()
+        if caps is None:
+            caps = pad.query_caps(None)
+        if not caps.get_structure(0).get_name().startswith('video/'):
+            return
+        sinkpad = self._filter0.get_static_pad('sink')
+        if not sinkpad.is_linked():
+            if pad.link(sinkpad) != Gst.PadLinkReturn.OK:
+                print('decodebin to %s link failed' % self._filter0.get_name())
+
+    def _open(self, fname):
+        """
+        Opens fname in the pipeline, prerolls and gets the frame rate, frame
+        size and duration of the video.
+
+        Returns True on success, False otherwise.
+        """
+        self.fname = fname
+        self.filesrc.set_property('location', fname)
 
+        # set to PAUSED to make the first frame arrive in the sink
         self.pipeline.set_state(Gst.State.PAUSED)
         # Wait for state change, i.e. block for up to 5 s.
         self.pipeline.get_state(5*Gst.SECOND)
 
+        if not self._crop is None:
+            if not self._set_crop(self._crop):
+                return False
+
         # Pull 1st sample to get framerate
         smp = self.appsink.emit('pull-preroll')
+        if smp is None:
+            print('Could not preroll %s.' % fname)
+            return False
         sinkcaps = smp.get_caps().get_structure(0)
         fps = sinkcaps.get_fraction("framerate")
         if not fps[0]:
             print('Frame rate is missing form file.')
-            return None
+            return False
 
         # Frame rate, frames per second
         self.fps_frac = (fps[1], fps[2])
@@ -1085,14 +3345,14 @@ class VideoReader:
         width = sinkcaps.get_int("width")
         if not width[0]:
             print('Frame width is missing from file.')
-            return None
+            return False
         self.width = width[1]
         #sinkcaps.set_value("width", self.width)
         # Get and set frame height
         height = sinkcaps.get_int("height")
         if not height[0]:
             print('Frame height is missing from file.')
-            return None
+            return False
         self.height = height[1]
         #sinkcaps.set_value("height", self.height)
 
@@ -1104,6 +3364,16 @@ class VideoReader:
 
         self.frame_size = np.prod(self.frame_shape)
 
+        # Row stride, in bytes, of the frames in the buffers. GStreamer pads
+        # each row of RGB and GRAY8 frames to a multiple of 4 bytes, so the
+        # buffers can be larger than the frames.
+        vinfo = _video_info_from_caps(smp.get_caps())
+        self.stride = vinfo.stride[0]
+        if len(self.frame_shape) == 2:
+            self._strides = (self.stride, 1)
+        else:
+            self._strides = (self.stride, 3, 1)
+
         # Duration of video in nano seconds, seconds and frames
         ret = self.pipeline.query_duration(Gst.Format.TIME)
         self.duration_nanoseconds = None
@@ -1116,19 +3386,83 @@ class VideoReader:
 
         if self.duration_nanoseconds is None:
             print('Duration query failed.')
-            return None
+            return False
+
+        # Pts, in ns, of the last frame read
+        self._pos_ns = smp.get_buffer().pts
+        # Timestamp track, read on first use
+        self._timestamps = None
+
+        # Frame index, pts and keyframe flags of every frame
+        self.index = None
+        if self._use_index and not self._rate is None:
+            print('The frame index is not used when fps is given.')
+        elif self._use_index:
+            self.index = get_frame_index(fname)
+            if not self.index is None:
+                # Exact number of frames
+                self.duration_nframes = len(self.index)
+
+        if not self.cache is None:
+            self.cache.clear()
+
+        return True
+
+    def reopen(self, fname):
+        """
+        Opens another video file in the same pipeline, with the same
+        options, without building a new pipeline.
 
-        # To avoid having to call buf.get_size() for every frame
-        self.buf_size = None
+        Returns True on success, False otherwise.
+        """
+        if not os.path.isfile(fname):
+            raise ValueError('No such file: %s' % fname)
 
-        # for some videos buf.get_size() returned 400 bytes more
-        # of data more than np.prod(self.frame_shape). I don't know why.
-        # This occurs for videoconvert to RGB and NOT RGBx
-        # (but I don't want a height x width x 4 shaped frame)
-        self._buf_wrong_size = False
+        self._release_mapped()
+        # decodebin drops its pads and decoders in READY. The new ones are
+        # linked in on_pad_added().
+        self.pipeline.set_state(Gst.State.READY)
+        self.pipeline.get_state(5*Gst.SECOND)
+        self.is_open = self._open(fname)
+        if not self.profiler is None:
+            self.profiler.add_elements()
+        return self.is_open
 
+    def _set_crop(self, crop):
+        """
+        Sets the crop rectangle (x, y, width, height) of the videocrop
+        element, which crops by the number of pixels to remove from each
+        side. Requires the size of the decoded video, so it is done once
+        the pipeline has prerolled, after which it prerolls again.
+        """
+        videocrop = self.pipeline.get_by_name('crop')
+        caps = videocrop.get_static_pad('sink').get_current_caps()
+        if caps is None:
+            print('Could not get the video size for cropping.')
+            return False
+        st = caps.get_structure(0)
+        src_width, src_height = st.get_int('width')[1], st.get_int('height')[1]
+
+        x, y, width, height = crop
+        right = src_width - x - width
+        bottom = src_height - y - height
+        if min(x, y, right, bottom) < 0 or width <= 0 or height <= 0:
+            raise ValueError('Crop rectangle %s is outside the %dx%d video.' %
+                             (str(crop), src_width, src_height))
+
+        videocrop.set_property('left', x)
+        videocrop.set_property('top', y)
+        videocrop.set_property('right', right)
+        videocrop.set_property('bottom', bottom)
+
+        # Preroll again, now with the cropped frame.
+        self.pipeline.seek_simple(Gst.Format.TIME,
+                                  Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE,
+                                  0)
+        self.pipeline.get_state(5*Gst.SECOND)
+        return True
 
-    def _get_current_frame(self):
+    def _get_current_frame(self, out=None, copy=True):
         """
         Reads the frame at the current position.
 
@@ -1139,44 +3473,91 @@ class VideoReader:
         smp = self.appsink.emit('pull-preroll')
 
         if not smp is None:
+            return self._sample_to_frame(smp, out=out, copy=copy)
+        else:
+            return None
 
-            buf = smp.get_buffer()
-
-            if self.buf_size is None:
-                self.buf_size = buf.get_size()
-                # Check for the buffer/frame size discrepancy
+    def _sample_to_frame(self, smp, out=None, copy=True):
+        """
+        Converts a sample pulled from the appsink to a frame.
 
-                # for some videos buf.get_size() returned 400 bytes more
-                # of data more than np.prod(self.frame_shape). I don't know why.
-                # This occurs for videoconvert to RGB and NOT RGBx
-                # (but I don't want a height x width x 4 shaped frame)
-                if self.buf_size > self.frame_size:
-                    self._buf_wrong_size = True
-                    # this hack seems to fix it
-                    step = self.buf_size // np.prod(self.frame_shape[0])
-                    rm_ix = np.arange(self.frame_shape[0]) * step
-                    self.keep_ix = np.ones(self.buf_size, dtype=bool)
-                    self.keep_ix[rm_ix-1] = False
-                    self.keep_ix[rm_ix-2] = False
+        The buffer is mapped and wrapped in a strided numpy view, i.e. the
+        padding at the end of each row is skipped without copying.
 
-            data = np.fromstring(buf.extract_dup(0, self.buf_size), dtype='uint8')
+        Parameters:
+        ----------
+        smp  : Gst.Sample
+        out  : Optional uint8 array with shape frame_shape to copy the frame
+               into. If given, out is returned.
+        copy : If False, and out is None, the returned frame is a read-only
+               view of the buffer memory. It is only valid until the next
+               frame is read from the reader.
 
-            if self._buf_wrong_size:
-                data = data[self.keep_ix]
+        Returns:
+        frame : An uint8 numpy array in RGB format.
+        """
+        self._release_mapped()
 
+        buf = smp.get_buffer()
+        self._pos_ns = buf.pts
+        # Strides and offset of the buffer itself if it carries a video meta,
+        # otherwise the default ones from the caps.
+        meta = GstVideo.buffer_get_video_meta(buf)
+        if meta is None:
+            strides, offset = self._strides, 0
+        else:
+            strides = (meta.stride[0],) + self._strides[1:]
+            offset = meta.offset[0]
 
-            return data.reshape(self.frame_shape)
+        mapinfo = _map_buffer(buf)
+        if mapinfo is None:
+            print('Failed to map buffer.')
+            return None
 
+        view = np.ndarray(shape=self.frame_shape,
+                          dtype=np.uint8,
+                          buffer=mapinfo.data,
+                          offset=offset,
+                          strides=strides)
+
+        if not out is None:
+            np.copyto(out, view)
+            frame = out
+        elif copy:
+            frame = view.copy()
         else:
-            return None
+            # Keep the buffer mapped until the next frame is read.
+            self._mapped = (buf, mapinfo)
+            return view
+
+        buf.unmap(mapinfo)
+        return frame
 
-    def get_frame(self, t):
+    def _release_mapped(self):
+        """
+        Unmaps the buffer backing the last frame returned with copy=False.
+        """
+        if not self._mapped is None:
+            buf, mapinfo = self._mapped
+            self._mapped = None
+            try:
+                buf.unmap(mapinfo)
+            except BufferError:
+                # A view of the memory is still alive. The memory is
+                # released together with the buffer instead.
+                pass
+
+    def get_frame(self, t, out=None, copy=True):
         """
         Reads a frame at time t.
 
         Parameter:
         ---------
-        t : time of frame in seconds.
+        t    : time of frame in seconds.
+        out  : Optional uint8 array with shape frame_shape to read the frame
+               into.
+        copy : If False, return a view of the buffer memory, valid until the
+               next frame is read. Default True.
 
         Returns:
         frame : An uint8 numpy array in RGB format.
@@ -1186,6 +3567,13 @@ class VideoReader:
             print('Requested frame time is after end of video.')
             return None
 
+        if not self.index is None:
+            return self.get_frame_by_number(self._frame_number_at(t),
+                                            out=out, copy=copy)
+
+        if not self.cache is None:
+            return self._get_frame_cached(t, out=out, copy=copy)
+
         ret = self.pipeline.seek_simple(Gst.Format.TIME,
                                         Gst.SeekFlags.FLUSH,
                                         t)
@@ -1195,15 +3583,38 @@ class VideoReader:
             print('Seek to time %1.4f s failed.' % t/Gst.SECOND)
             return None
         else:
-            return self._get_current_frame()
+            return self._get_current_frame(out=out, copy=copy)
 
-    def get_next_frame(self):
+    def get_next_frame(self, out=None, copy=True):
         """
         Reads the next frame from current position.
 
+        Parameter:
+        ---------
+        out  : Optional uint8 array with shape frame_shape to read the frame
+               into.
+        copy : If False, return a view of the buffer memory, valid until the
+               next frame is read. Default True.
+
         Returns:
         frame : An uint8 numpy array in RGB format.
         """
+        if not self.index is None:
+            n = self._frame_number_at(self._pos_ns) + 1
+            if n >= len(self.index):
+                print('Requested frame time is after end of video.')
+                return None
+            return self.get_frame_by_number(n, out=out, copy=copy)
+
+        if not self.cache is None:
+            # The pipeline position is not that of the last frame read when
+            # it came from the cache.
+            t = self._pos_ns + self.dt_ns
+            if self.duration_nanoseconds < t:
+                print('Requested frame time is after end of video.')
+                return None
+            return self._get_frame_cached(t, out=out, copy=copy)
+
         ret = self.pipeline.query_position(Gst.Format.TIME)
         if not ret[0]:
             print('Position query failed.')
@@ -1255,7 +3666,304 @@ class VideoReader:
 #                      ' %d, new frame num: %d' % (old_pos, new_pos))
 #            return None
         else:
-            return self._get_current_frame()
+            return self._get_current_frame(out=out, copy=copy)
+
+    def get_frame_by_number(self, n, out=None, copy=True):
+        """
+        Reads frame number n, counted from 0. Requires the frame index.
+
+        Seeks to the exact pts of the frame. The demuxer starts from the
+        nearest preceding keyframe and the frames between the keyframe and
+        frame n are decoded and dropped, so the returned frame is always
+        frame n.
+
+        Parameter:
+        ---------
+        n    : frame number (int)
+        out  : Optional uint8 array with shape frame_shape to read the frame
+               into.
+        copy : If False, return a view of the buffer memory, valid until the
+               next frame is read. Default True.
+
+        Returns:
+        frame : An uint8 numpy array in RGB format.
+        """
+        if self.index is None:
+            print('get_frame_by_number requires the frame index, '
+                  'use VideoReader(fname, index=True).')
+            return None
+
+        if not (0 <= n < len(self.index)):
+            print('Frame number %d is outside the video, '
+                  'which has %d frames.' % (n, len(self.index)))
+            return None
+
+        t = int(self.index['pts'][n])
+        if not self.cache is None:
+            return self._get_frame_cached(t, out=out, copy=copy)
+
+        ret = self.pipeline.seek_simple(Gst.Format.TIME,
+                                        Gst.SeekFlags.FLUSH |
+                                        Gst.SeekFlags.ACCURATE,
+                                        t)
+        # Wait for state change, i.e. block for up to 5 s.
+        self.pipeline.get_state(5*Gst.SECOND)
+        if not ret:
+            print('Seek to frame %d failed.' % n)
+            return None
+
+        frame = self._get_current_frame(out=out, copy=copy)
+        if not frame is None and self._pos_ns != t:
+            print('Seek to frame %d landed at %1.4f s, not at %1.4f s.' %
+                  (n, self._pos_ns/Gst.SECOND, t/Gst.SECOND))
+        return frame
+
+    def _get_frame_cached(self, t, out=None, copy=True):
+        """
+        Reads the frame at time t (ns) through the frame cache.
+
+        On a miss, decoding starts at the keyframe before t and all frames
+        decoded on the way to t are added to the cache, as they had to be
+        decoded anyway.
+        """
+        if self.index is None:
+            tol = self.dt_ns // 2
+        else:
+            tol = 0  # t is the exact pts of a frame
+        ret = self.cache.get(t, tol=tol)
+
+        if ret is None:
+            if self.index is None:
+                t0, t1 = t, t + tol
+            else:
+                t0 = self.index['pts'][:self._frame_number_at(t)+1]
+                t0 = t0[self.index['keyframe'][:len(t0)]]
+                t0 = int(t0[-1]) if len(t0) else t
+                t1 = t
+            for pts, frame in self._iter_frames_ns(t0, t1, keyframe=True):
+                self.cache.put(pts, frame)
+                if pts + tol >= t:
+                    ret = pts, frame
+                    break
+            if ret is None:
+                print('Could not read frame at time %1.4f s.' %
+                      (t/Gst.SECOND))
+                return None
+
+        pts, frame = ret
+        self._pos_ns = pts
+        if not out is None:
+            np.copyto(out, frame)
+            return out
+        elif copy:
+            return frame.copy()
+        else:
+            return frame
+
+    def _frame_number_at(self, t):
+        """
+        Returns the number of the frame shown at time t (ns), i.e. the last
+        frame with pts <= t. Requires the frame index.
+        """
+        # 1 us tolerance for rounding errors in times given in seconds.
+        n = np.searchsorted(self.index['pts'], t + 1000, side='right') - 1
+        return max(int(n), 0)
+
+    def iter_frames(self, t0=0.0, t1=None, copy=True):
+        """
+        Iterates over the frames from time t0 to t1.
+
+        Seeks once to t0 and then decodes sequentially with the pipeline in
+        PLAYING, pulling the frames from the appsink. Much faster than
+        calling get_next_frame() repeatedly, which does a flushing seek and a
+        new preroll for every frame.
+
+        Example:
+            for t, frame in reader.iter_frames(10.0, 20.0):
+                ...
+
+        Parameters:
+        ----------
+        t0 : time of first frame in seconds.
+        t1 : time of last frame in seconds.
+             Default None, i.e. until end of video.
+        copy : If False, the frames are views of the buffer memory, only
+               valid until the next iteration. Default True.
+
+        Yields:
+        ------
+        t     : time of frame in seconds.
+        frame : An uint8 numpy array in RGB format.
+        """
+        t0 = int(round(t0 * Gst.SECOND))
+        if t1 is None:
+            t1 = self.duration_nanoseconds
+        else:
+            t1 = int(round(t1 * Gst.SECOND))
+
+        for pts, frame in self._iter_frames_ns(t0, t1, copy=copy):
+            yield pts / Gst.SECOND, frame
+
+    def _iter_frames_ns(self, t0, t1, copy=True, keyframe=False):
+        """
+        Same as iter_frames() but with t0, t1 and the yielded frame times in
+        nano seconds (int). If keyframe is True iteration starts at the
+        keyframe before t0 instead of at t0.
+        """
+        if self.duration_nanoseconds < t0:
+            print('Requested frame time is after end of video.')
+            return
+
+        # Unless keyframe, ACCURATE so that the first frame is the one at t0
+        # and not the keyframe before it.
+        if keyframe:
+            flags = (Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT |
+                     Gst.SeekFlags.SNAP_BEFORE)
+        else:
+            flags = Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE
+        ret = self.pipeline.seek_simple(Gst.Format.TIME, flags, t0)
+        # Wait for state change, i.e. block for up to 5 s.
+        self.pipeline.get_state(5*Gst.SECOND)
+        if not ret:
+            print('Seek to time %1.4f s failed.' % (t0/Gst.SECOND))
+            return
+
+        self.pipeline.set_state(Gst.State.PLAYING)
+        try:
+            while True:
+                # Blocks until a sample is available, returns None at EOS.
+                smp = self.appsink.emit('pull-sample')
+                if smp is None:
+                    break
+                pts = smp.get_buffer().pts
+                if pts > t1:
+                    break
+                yield pts, self._sample_to_frame(smp, copy=copy)
+        finally:
+            # Back to PAUSED, also if the caller breaks out of the loop.
+            self.pipeline.set_state(Gst.State.PAUSED)
+            self.pipeline.get_state(5*Gst.SECOND)
+
+    def get_frames(self, times, unit='time', out=None, max_gap=2.0):
+        """
+        Reads many frames in one call.
+
+        The requested frames are sorted and grouped by GOP (with the frame
+        index), or by gaps shorter than max_gap (without it). Each group is
+        decoded in a single forward pass with one seek, and the frames are
+        written directly into one preallocated array.
+
+        Parameters:
+        ----------
+        times   : array_like with frame times in seconds, or frame numbers
+                  if unit is 'frame_number'. Need not be sorted and may
+                  contain repeats.
+        unit    : 'time' (default) or 'frame_number'. Frame numbers
+                  require the frame index.
+        out     : Optional uint8 array with shape (len(times),) + frame_shape
+                  to read the frames into.
+        max_gap : Without the frame index, requested times closer than
+                  max_gap seconds are read in the same pass. Default 2.0 s.
+
+        Returns:
+        frames : An uint8 numpy array with shape (len(times),) + frame_shape,
+                 with the frames in the same order as times.
+        """
+        times = np.asarray(times).ravel()
+        n = len(times)
+        if out is None:
+            out = np.empty((n,) + tuple(self.frame_shape), dtype=np.uint8)
+        elif out.shape != (n,) + tuple(self.frame_shape):
+            raise ValueError('out has shape %s, expected %s' %
+                             (out.shape, (n,) + tuple(self.frame_shape)))
+        if n == 0:
+            return out
+
+        if unit == 'frame_number':
+            if self.index is None:
+                print('Frame numbers require the frame index, '
+                      'use VideoReader(fname, index=True).')
+                return None
+            frame_n = times.astype(int)
+            if frame_n.min() < 0 or frame_n.max() >= len(self.index):
+                print('Requested frame numbers outside of video.')
+                return None
+            t = self.index['pts'][frame_n]
+        elif unit == 'time':
+            t = np.round(times * Gst.SECOND).astype(np.int64)
+            if t.max() > self.duration_nanoseconds:
+                print('Requested frame time is after end of video.')
+                return None
+            if not self.index is None:
+                # Snap to the pts of the frames shown at the requested times
+                frame_n = np.searchsorted(self.index['pts'], t + 1000,
+                                          side='right') - 1
+                t = self.index['pts'][np.maximum(frame_n, 0)]
+        else:
+            print('%s is not a vaild unit. '
+                  'Valid units are "time" | "frame_number"' % unit)
+            return None
+
+        order = np.argsort(t, kind='stable')
+        t = t[order]
+
+        # Split into groups that are decoded in one pass each
+        if not self.index is None:
+            key_pts = self.index['pts'][self.index['keyframe']]
+            gop = np.searchsorted(key_pts, t, side='right')
+            # Requests in the same or in adjacent GOPs share one pass
+            split = np.nonzero(np.diff(gop) > 1)[0] + 1
+        else:
+            split = np.nonzero(np.diff(t) > max_gap * Gst.SECOND)[0] + 1
+        bounds = np.concatenate(([0], split, [n]))
+
+        half_dt = self.dt_ns // 2
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            i = start
+            t0 = max(int(t[start]) - half_dt, 0)
+            t1 = int(t[stop-1]) + half_dt
+            for pts, frame in self._iter_frames_ns(t0, t1, copy=False):
+                # A requested time gets the frame with the nearest pts
+                while i < stop and t[i] < pts + half_dt:
+                    out[order[i]] = frame
+                    i += 1
+                if i == stop:
+                    break
+            if i < stop:
+                print('%d requested frames could not be read.' % (stop - i))
+                out[order[i:stop]] = 0
+
+        self._release_mapped()
+
+        return out
+
+    def get_timestamps(self):
+        """
+        Returns the timestamp track of the video, see read_timestamp_track,
+        or None if it has none.
+        """
+        if self._timestamps is None:
+            self._timestamps = read_timestamp_track(self.fname)
+        return self._timestamps
+
+    def get_current_timestamp(self):
+        """
+        Returns the timestamp track record, (pts, frame_n, buf_ts, py_ts), of
+        the last frame read, or None if there is none within half a frame.
+        """
+        records = self.get_timestamps()
+        if records is None or not len(records):
+            return None
+        i = np.searchsorted(records['pts'], self._pos_ns)
+        best = None
+        for j in (i - 1, i):
+            if 0 <= j < len(records):
+                d = abs(int(records['pts'][j]) - self._pos_ns)
+                if best is None or d < best[0]:
+                    best = (d, j)
+        if best[0] > self.dt_ns // 2:
+            return None
+        return records[best[1]]
 
     def get_current_position(self, fmt='time'):
         """
@@ -1270,10 +3978,18 @@ class VideoReader:
         """
 
         pos = None
-        if fmt == 'time':
+        if fmt == 'time' and self._pos_ns != Gst.CLOCK_TIME_NONE:
+            # The pts of the last read frame. The pipeline position is
+            # ahead of it after read-ahead, and does not move on frame
+            # cache hits.
+            pos = self._pos_ns/Gst.SECOND
+        elif fmt == 'time':
             ret = self.pipeline.query_position(Gst.Format.TIME)
             if ret[0]:
                 pos = ret[1]/Gst.SECOND
+        elif fmt == 'frame_number' and not self.index is None:
+            # Exact, from the pts of the last read frame.
+            pos = self._frame_number_at(self._pos_ns)
         elif fmt == 'frame_number':
             ret = self.pipeline.query_position(Gst.Format.BUFFERS)
             if ret[0] and ret[1] >= 0:  # TODO: ret[0] == True even when the
@@ -1299,6 +4015,358 @@ class VideoReader:
         """
         Closes the pipeline.
         """
+        self._release_mapped()
+        if not self.profiler is None:
+            self.profiler.stop()
         self.pipeline.set_state(Gst.State.NULL)
         # Wait for state change, i.e. block for up to 5 s.
         self.pipeline.get_state(5*Gst.SECOND)
+
+
+def _attach_shared_memory(name):
+    """
+    Attaches to an existing shared memory block without registering it with
+    the resource tracker (where supported), since its creator unlinks it.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13
+        return shared_memory.SharedMemory(name=name)
+
+
+# VideoReader of a ParallelVideoReader worker process
+_worker_reader = None
+
+
+def _init_parallel_worker(fname, color):
+    """
+    Initializer of ParallelVideoReader worker processes. Each worker keeps
+    one VideoReader open for all the chunks it decodes.
+    """
+    global _worker_reader
+    _worker_reader = VideoReader(fname, color=color, index=True)
+
+
+def _read_chunk(start, stop, shm_name):
+    """
+    ParallelVideoReader worker. Reads frames start to stop-1 into the shared
+    memory block shm_name.
+    """
+    shm = _attach_shared_memory(shm_name)
+    try:
+        frames = np.ndarray((stop - start,) + tuple(_worker_reader.frame_shape),
+                            dtype=np.uint8, buffer=shm.buf)
+        _worker_reader.get_frames(np.arange(start, stop),
+                                  unit='frame_number', out=frames)
+        del frames
+    finally:
+        shm.close()
+
+
+def _map_chunk(task):
+    """
+    ParallelVideoReader worker. task is (start, stop, func). Returns a list
+    with func(frame) for frames start to stop-1.
+    """
+    start, stop, func = task
+    pts = _worker_reader.index['pts']
+    results = []
+    for t, frame in _worker_reader._iter_frames_ns(int(pts[start]),
+                                                   int(pts[stop-1]),
+                                                   copy=False):
+        results.append(func(frame))
+    if len(results) != stop - start:
+        print('Read %d frames, expected %d, from frame %d.' %
+              (len(results), stop - start, start))
+    return results
+
+
+class ParallelVideoReader:
+    """
+    Decodes one video in parallel, in several worker processes.
+
+    The video is split into chunks starting at keyframes, so that each chunk
+    can be decoded independently of the others. Each worker process has its
+    own VideoReader. Frames are returned through shared memory, results of
+    a per-frame function through the process pool. Both come back in order.
+
+    Example:
+        pvr = ParallelVideoReader(fname, n_workers=16)
+        means = pvr.map(np.mean)
+        for t, frame in pvr.iter_frames():
+            ...
+        pvr.close()
+
+    func given to map() must be picklable, i.e. defined at module level.
+    """
+
+    def __init__(self, fname, n_workers=None, color=True, chunk_seconds=2.0):
+        """
+        fname         -- video filename (str)
+        n_workers     -- number of worker processes (int).
+                         Default None, one per CPU.
+        color         -- Whether to return frames in color or gray scale (bool)
+        chunk_seconds -- minimum duration, in seconds, of the chunks given to
+                         the workers (float). Chunks are at least one GOP.
+                         iter_frames() keeps n_workers + 2 chunks of frames
+                         in shared memory.
+        """
+        if n_workers is None:
+            n_workers = os.cpu_count()
+        self.fname = fname
+        self.color = color
+        self.n_workers = n_workers
+
+        # Builds or loads the frame index, shared with the workers via the
+        # sidecar file.
+        vr = VideoReader(fname, color=color, index=True)
+        self.index = vr.index
+        self.frame_shape = tuple(vr.frame_shape)
+        self.frame_size = int(vr.frame_size)
+        vr.close()
+        if self.index is None:
+            raise RuntimeError('Could not build the frame index of %s' % fname)
+
+        # Split at keyframes into chunks of at least chunk_seconds
+        pts = self.index['pts']
+        keyframes = np.nonzero(self.index['keyframe'])[0]
+        starts = [0]
+        for k in keyframes:
+            if pts[k] - pts[starts[-1]] >= chunk_seconds * Gst.SECOND:
+                starts.append(int(k))
+        self.chunks = list(zip(starts, starts[1:] + [len(self.index)]))
+
+        # GStreamer does not survive fork, hence spawn.
+        ctx = multiprocessing.get_context('spawn')
+        self.pool = ctx.Pool(n_workers,
+                             initializer=_init_parallel_worker,
+                             initargs=(fname, color))
+        self._shm = []
+
+    def map(self, func):
+        """
+        Returns a list with func(frame) for every frame of the video, in
+        order. frame is only valid during the call.
+        """
+        results = []
+        for res in self.imap(func):
+            results.extend(res)
+        return results
+
+    def imap(self, func):
+        """
+        Iterates over the chunks, in order, yielding a list with func(frame)
+        for the frames of each chunk.
+        """
+        tasks = [(start, stop, func) for start, stop in self.chunks]
+        for res in self.pool.imap(_map_chunk, tasks):
+            yield res
+
+    def iter_frames(self, copy=True):
+        """
+        Iterates over all frames of the video, in order.
+
+        Parameters:
+        ----------
+        copy : If False, the frames are views of the shared memory, only
+               valid until the next iteration. Default True.
+
+        Yields:
+        ------
+        t     : time of frame in seconds.
+        frame : An uint8 numpy array in RGB format.
+        """
+        n_slots = self.n_workers + 2
+        pending = deque()  # (shm, start, stop, async result), in chunk order
+        chunks = iter(self.chunks)
+
+        try:
+            while True:
+                # Keep up to n_slots chunks in flight, each in a shared
+                # memory block sized for it
+                while len(pending) < n_slots:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    shm = shared_memory.SharedMemory(
+                        create=True, size=(chunk[1] - chunk[0])*self.frame_size)
+                    self._shm.append(shm)
+                    res = self.pool.apply_async(_read_chunk,
+                                                chunk + (shm.name,))
+                    pending.append((shm, chunk[0], chunk[1], res))
+                if not pending:
+                    break
+
+                shm, start, stop, res = pending.popleft()
+                frames = frame = None
+                try:
+                    res.get()  # Waits for the chunk, re-raises worker errors
+                    frames = np.ndarray((stop - start,) + self.frame_shape,
+                                        dtype=np.uint8, buffer=shm.buf)
+                    pts = self.index['pts'][start:stop]
+                    for t, frame in zip(pts, frames):
+                        if copy:
+                            frame = frame.copy()
+                        yield t / Gst.SECOND, frame
+                finally:
+                    # No views of the shared memory may remain when it is
+                    # closed.
+                    frame = None
+                    frames = None
+                    self._free_shm(shm)
+        finally:
+            # Iteration stopped early, e.g. by break: wait for the workers
+            # still writing into shared memory before freeing it.
+            for shm, start, stop, res in pending:
+                res.wait()
+                self._free_shm(shm)
+
+    def _free_shm(self, shm):
+        """
+        Closes and unlinks a shared memory block of iter_frames().
+        """
+        self._shm.remove(shm)
+        shm.unlink()
+        try:
+            shm.close()
+        except BufferError:
+            # A frame returned with copy=False is still alive. The memory
+            # is released together with it instead.
+            pass
+
+    def close(self):
+        """
+        Stops the worker processes and frees the shared memory.
+        """
+        self.pool.close()
+        self.pool.join()
+        for shm in list(self._shm):
+            self._free_shm(shm)
+
+
+class VideoReaderPool:
+    """
+    Pool of VideoReaders whose pipelines are reused for new files.
+
+    Building and prerolling a pipeline costs more than decoding a short
+    clip. A reader returned to the pool keeps its pipeline, and the next
+    file is opened in it with VideoReader.reopen(), which only swaps the
+    filesrc location and prerolls again.
+
+    Example:
+        pool = VideoReaderPool(max_readers=4, color=False)
+        for fname in fnames:
+            with pool.reader(fname) as vr:
+                frame = vr.get_frame(1.0)
+        print(pool.stats())
+        pool.close()
+
+    Safe to use from several threads, at most max_readers pipelines exist
+    at the same time.
+    """
+
+    def __init__(self, max_readers=4, **reader_kwargs):
+        """
+        max_readers   -- maximum number of live pipelines (int)
+        reader_kwargs -- keyword arguments for VideoReader, the same for all
+                         readers of the pool, e.g. color=False.
+        """
+        self.max_readers = max_readers
+        self.reader_kwargs = reader_kwargs
+        self._idle = []
+        self._n_live = 0
+        self._cond = threading.Condition()
+        # Setup times, in seconds, of the most recent opens
+        self._cold_times = deque(maxlen=10000)  # new pipeline
+        self._warm_times = deque(maxlen=10000)  # reused pipeline
+
+    def acquire(self, fname, timeout=None):
+        """
+        Returns a VideoReader with fname opened. Blocks, for at most timeout
+        seconds, if max_readers readers are already in use.
+        Return the reader with release() when done with it.
+
+        Returns None if fname could not be opened.
+        """
+        with self._cond:
+            while not self._idle and self._n_live >= self.max_readers:
+                if not self._cond.wait(timeout):
+                    raise RuntimeError('No free VideoReader within %s s' %
+                                       timeout)
+            if self._idle:
+                reader = self._idle.pop()
+            else:
+                reader = None
+                self._n_live += 1
+
+        t0 = time.perf_counter()
+        try:
+            if reader is None:
+                reader = VideoReader(fname, **self.reader_kwargs)
+                ok = reader.is_open
+                self._cold_times.append(time.perf_counter() - t0)
+            else:
+                ok = reader.reopen(fname)
+                self._warm_times.append(time.perf_counter() - t0)
+        except Exception:
+            if reader is None:
+                with self._cond:
+                    self._n_live -= 1
+                    self._cond.notify()
+            else:
+                self.release(reader)
+            raise
+
+        if not ok:
+            self.release(reader)
+            return None
+
+        return reader
+
+    def release(self, reader):
+        """
+        Returns a reader to the pool.
+        """
+        with self._cond:
+            self._idle.append(reader)
+            self._cond.notify()
+
+    @contextmanager
+    def reader(self, fname, timeout=None):
+        """
+        Context manager version of acquire() and release().
+        """
+        reader = self.acquire(fname, timeout=timeout)
+        try:
+            yield reader
+        finally:
+            if not reader is None:
+                self.release(reader)
+
+    def stats(self):
+        """
+        Returns a dict with the number of live and idle readers, and the
+        number, mean, median and 95th percentile of the setup times, in
+        seconds, of new (cold) and reused (warm) pipelines.
+        """
+        st = {'n_live': self._n_live, 'n_idle': len(self._idle)}
+        for name, times in (('cold', self._cold_times),
+                            ('warm', self._warm_times)):
+            times = np.array(times)
+            st['%s_n' % name] = len(times)
+            if len(times):
+                st['%s_mean' % name] = times.mean()
+                st['%s_median' % name] = np.median(times)
+                st['%s_p95' % name] = np.percentile(times, 95)
+        return st
+
+    def close(self):
+        """
+        Closes the idle readers. Readers still in use have to be closed by
+        the caller.
+        """
+        with self._cond:
+            for reader in self._idle:
+                reader.close()
+            self._n_live -= len(self._idle)
+            self._idle = []